@@ -3,3 +3,8 @@ from .config import *
 from .embedding import *
 from .prompt import *
 from .retriever import *
+from .bm25 import *
+from .native_index import *
+from .shared_index import *
+from .ann import *
+from .template_index import *
@@ -0,0 +1,88 @@
+# Copyright 2024, OpenCUI
+# Licensed under the Apache License, Version 2.0.
+
+import json
+import os
+
+import numpy as np
+
+from opendu.core.config import RauConfig
+
+
+#
+# The approximate nearest neighbor search over the normalized embeddings of a tag, for the large
+# exemplar sets where scoring every row is too slow. This uses the HNSW graph from hnswlib with
+# inner product, so the score is the same cosine as the exact search. The graph is built at index
+# time and saved next to the native index, with the digest of the node ids it is built for, so that
+# a graph is never used with the rows of another index. hnswlib is only needed for hnsw.
+#
+class HnswIndex:
+    file = "hnsw.bin"
+    meta = "hnsw.json"
+
+    def __init__(self, index):
+        self.index = index
+
+    @staticmethod
+    def module():
+        try:
+            import hnswlib
+        except ImportError:
+            raise RuntimeError("vector_backend hnsw needs hnswlib, please pip install hnswlib.")
+        return hnswlib
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(f"{path}/{HnswIndex.file}") and os.path.exists(f"{path}/{HnswIndex.meta}")
+
+    @staticmethod
+    def build(embeddings: np.ndarray):
+        config = RauConfig.get()
+        index = HnswIndex.module().Index(space="ip", dim=embeddings.shape[1])
+        index.init_index(max_elements=embeddings.shape[0], ef_construction=config.hnsw_ef_construction, M=config.hnsw_m)
+        index.add_items(np.asarray(embeddings, dtype=np.float32), np.arange(embeddings.shape[0]))
+        return HnswIndex(index)
+
+    # The digest is written after the graph, so it marks a complete graph.
+    def save(self, path: str, digest: str):
+        self.index.save_index(f"{path}/{HnswIndex.file}.tmp")
+        os.replace(f"{path}/{HnswIndex.file}.tmp", f"{path}/{HnswIndex.file}")
+        with open(f"{path}/{HnswIndex.meta}.tmp", "w") as file:
+            json.dump({"digest": digest, "rows": len(self)}, file)
+        os.replace(f"{path}/{HnswIndex.meta}.tmp", f"{path}/{HnswIndex.meta}")
+
+    @staticmethod
+    def remove(path: str):
+        for name in [HnswIndex.meta, HnswIndex.file]:
+            if os.path.exists(f"{path}/{name}"):
+                os.remove(f"{path}/{name}")
+
+    # Whether the saved graph is built for the nodes with this digest.
+    @staticmethod
+    def matches(path: str, digest: str) -> bool:
+        if not HnswIndex.exists(path):
+            return False
+        with open(f"{path}/{HnswIndex.meta}") as file:
+            return json.load(file)["digest"] == digest
+
+    @staticmethod
+    def load(path: str, dim: int):
+        index = HnswIndex.module().Index(space="ip", dim=dim)
+        index.load_index(f"{path}/{HnswIndex.file}")
+        index.set_ef(RauConfig.get().hnsw_ef_search)
+        return HnswIndex(index)
+
+    def __len__(self):
+        return self.index.get_current_count()
+
+    # This returns the rows and scores of the top k for each query, best first.
+    def search(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        k = min(k, len(self))
+        if self.index.ef < k:
+            self.index.set_ef(k)
+        rows, distances = self.index.knn_query(np.asarray(queries, dtype=np.float32), k=k)
+        return rows, 1.0 - distances
+
+    # The vectors and the links of each element at the base layer.
+    def resident_size(self) -> int:
+        return len(self) * (4 * self.index.dim + 8 * self.index.M + 16)
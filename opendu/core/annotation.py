@@ -1,3 +1,4 @@
+import hashlib
 import json
 import re
 from typing import Dict, List, Literal, TypedDict, Set
@@ -243,6 +244,11 @@ class MatchReplace:
         return f"< {slot_name} >"
 
 
+# Python hash is randomized for each process, node id need to be stable across the restarts.
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
 def build_nodes_from_exemplar_store(module_schema: Schema, store: ExemplarStore, nodes: List[TextNode]):
     pattern = re.compile(r"<(.+?)>")
     for label, exemplars in store.items():
@@ -255,8 +261,10 @@ def build_nodes_from_exemplar_store(module_schema: Schema, store: ExemplarStore,
                 continue
 
             context_frame = get_value(exemplar, "context_frame", None)
-            full_text = f'{text} : {label}'
-            hashed_id = str(hash(full_text))
+            context_slot = get_value(exemplar, "context_slot", None)
+            owner_mode = get_value(exemplar, "owner_mode", "normal")
+            full_text = f'{text} : {label} : {context_frame} : {context_slot} : {owner_mode}'
+            hashed_id = content_hash(full_text)
             nodes.append(
                 TextNode(
                     text=text,
@@ -265,8 +273,8 @@ def build_nodes_from_exemplar_store(module_schema: Schema, store: ExemplarStore,
                         "owner": label,
                         "template": template,  # This is the original template
                         "context_frame": context_frame,
-                        "context_slot": get_value(exemplar, "context_slot", None),
-                        "owner_mode": get_value(exemplar, "owner_mode", "normal"),
+                        "context_slot": context_slot,
+                        "owner_mode": owner_mode,
                     },
                     excluded_embed_metadata_keys=["owner", "context_frame", "context_slot", "owner_mode", "template"],
                 )
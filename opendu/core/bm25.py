@@ -0,0 +1,153 @@
+# Copyright 2024, OpenCUI
+# Licensed under the Apache License, Version 2.0.
+
+import json
+import os
+import re
+import sys
+from collections import Counter
+from typing import Sequence
+
+import numpy as np
+from scipy import sparse
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import BaseNode, NodeWithScore, QueryBundle
+
+
+# We keep negation and yes/no out of this, they are important for short utterance.
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "i", "in", "is", "it", "its",
+    "me", "my", "of", "on", "or", "so", "that", "the", "this", "to", "was", "we", "with", "you"
+}
+
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in re.findall(r"\w+", text.lower()) if token not in STOPWORDS]
+
+
+def save_atomic(path: str, array: np.ndarray):
+    # Loaded postings are memory mapped, so we never write into the file in place.
+    with open(f"{path}.tmp", "wb") as file:
+        np.save(file, array)
+    os.replace(f"{path}.tmp", path)
+
+
+#
+# The BM25 postings for keyword search, built at index time and saved to index directory so that
+# loading a bot does not need to re-tokenize and re-count every node. We keep a term by document
+# CSR matrix whose values already have idf and length normalization applied, so scoring a query
+# is one sparse vector and matrix product, and scoring many queries is one sparse matrix product.
+# The arrays are opened with memory mapping.
+#
+class BM25Postings:
+    arrays = ["indptr", "doc_ids", "weights"]
+
+    def __init__(self, vocab: list[str], node_ids: list[str], indptr, doc_ids, weights):
+        self.vocab = vocab
+        self.term_ids = {term: index for index, term in enumerate(vocab)}
+        self.node_ids = node_ids
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.matrix = sparse.csr_matrix(
+            (weights, doc_ids, indptr), shape=(len(vocab), len(node_ids)), copy=False)
+
+    @staticmethod
+    def build(node_ids: list[str], texts: list[str], k1=1.5, b=0.75):
+        counts = [Counter(tokenize(text)) for text in texts]
+        vocab = sorted({term for count in counts for term in count})
+        term_ids = {term: index for index, term in enumerate(vocab)}
+
+        rows, cols, tfs = [], [], []
+        for doc, count in enumerate(counts):
+            for term, tf in count.items():
+                rows.append(term_ids[term])
+                cols.append(doc)
+                tfs.append(tf)
+
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        tfs = np.asarray(tfs, dtype=np.float32)
+        num_docs = len(texts)
+        doc_lengths = np.asarray([sum(count.values()) for count in counts], dtype=np.float32)
+        avg_length = float(doc_lengths.mean()) if num_docs != 0 else 1.0
+        dfs = np.bincount(rows, minlength=len(vocab)).astype(np.float32)
+        idfs = np.log(1.0 + (num_docs - dfs + 0.5) / (dfs + 0.5))
+        norms = k1 * (1.0 - b + b * doc_lengths[cols] / max(avg_length, 1.0))
+        weights = idfs[rows] * tfs * (k1 + 1.0) / (tfs + norms)
+
+        matrix = sparse.csr_matrix((weights, (rows, cols)), shape=(len(vocab), num_docs), dtype=np.float32)
+        matrix.sort_indices()
+        return BM25Postings(vocab, node_ids, matrix.indptr, matrix.indices, matrix.data)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        names = [f"{name}.npy" for name in BM25Postings.arrays] + ["terms.json"]
+        return all(os.path.exists(f"{path}/{name}") for name in names)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        for name in BM25Postings.arrays:
+            save_atomic(f"{path}/{name}.npy", np.asarray(getattr(self, name)))
+        with open(f"{path}/terms.json.tmp", "w") as file:
+            json.dump({"vocab": self.vocab, "node_ids": self.node_ids}, file)
+        os.replace(f"{path}/terms.json.tmp", f"{path}/terms.json")
+
+    @staticmethod
+    def load(path: str):
+        with open(f"{path}/terms.json") as file:
+            terms = json.load(file)
+        arrays = [np.load(f"{path}/{name}.npy", mmap_mode="r") for name in BM25Postings.arrays]
+        return BM25Postings(terms["vocab"], terms["node_ids"], *arrays)
+
+    # Each query is a binary row over the vocabulary, unknown terms are dropped.
+    def encode(self, queries: list[str]) -> sparse.csr_matrix:
+        indptr = [0]
+        indices = []
+        for query in queries:
+            term_ids = {self.term_ids[term] for term in tokenize(query) if term in self.term_ids}
+            indices.extend(sorted(term_ids))
+            indptr.append(len(indices))
+        data = np.ones(len(indices), dtype=np.float32)
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(queries), len(self.vocab)))
+
+    # The arrays are memory mapped, but they are all touched by scoring, so we count them.
+    def resident_size(self) -> int:
+        arrays = sum(np.asarray(getattr(self, name)).nbytes for name in BM25Postings.arrays)
+        return arrays + sum(sys.getsizeof(term) for term in self.vocab)
+
+    def score(self, query: str) -> np.ndarray:
+        return self.score_batch([query]).toarray()[0]
+
+    def score_batch(self, queries: list[str]) -> sparse.csr_matrix:
+        return (self.encode(queries) @ self.matrix).tocsr()
+
+
+# This returns the nodes with positive BM25 score, best first. The nodes are indexed by the
+# document id of the postings, and built on access.
+class KeywordRetriever(BaseRetriever):
+    def __init__(self, postings: BM25Postings, nodes: Sequence[BaseNode], topk: int):
+        super().__init__()
+        assert len(nodes) == len(postings.node_ids)
+        self._postings = postings
+        self._nodes = nodes
+        self._topk = topk
+
+    # The nodes are a view of the vector nodes, so they take little extra.
+    def resident_size(self) -> int:
+        return self._postings.resident_size() + self._nodes.resident_size()
+
+    def top_k(self, doc_ids: np.ndarray, scores: np.ndarray) -> list[NodeWithScore]:
+        top = np.argsort(-scores, kind="stable")[:self._topk]
+        return [NodeWithScore(node=self._nodes[doc_ids[index]], score=float(scores[index])) for index in top]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        return self.retrieve_batch([query_bundle.query_str])[0]
+
+    def retrieve_batch(self, queries: list[str]) -> list[list[NodeWithScore]]:
+        scores = self._postings.score_batch(queries)
+        results = []
+        for row in range(scores.shape[0]):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            results.append(self.top_k(scores.indices[start:end], scores.data[start:end]))
+        return results
@@ -40,6 +40,9 @@ class InferenceConfig(BaseModel):
     embedding_device: str = DEVICE
     #embedding_model: str = "BAAI/bge-base-en-v1.5"
     embedding_model: str = "dunzhang/stella_en_400M_v5"
+    # Keep only the leading dimensions of the Stella embeddings, 0 for the full dimension.
+    # Changing this requires indexing the bots again.
+    embedding_dimension: int = 0
 
 
     # We might not want to touch this, without rerun find_k
@@ -47,6 +50,37 @@ class InferenceConfig(BaseModel):
     exemplar_retrieve_topk: int = 8
     exemplar_retrieve_arity: int = 8
 
+    # How the hybrid search fuses the vector and keyword results: sum of raw scores, rrf
+    # (reciprocal rank with rrf_k), minmax or zscore normalized scores.
+    fusion_mode: str = "sum"
+    rrf_k: int = 60
+
+    # How many query embeddings we keep in cache, 0 disables the cache.
+    query_embedding_cache_size: int = 4096
+
+    # Where we keep the embeddings of indexed texts across re-indexes and bots, "" disables it.
+    embedding_cache_path: str = "./cache/embeddings"
+
+    # The dtype for the embedding matrix of the vector search, float32 or float16. With float16 the
+    # matrix takes half the memory, but its rows are upcast to float32 for each search.
+    vector_dtype: str = "float32"
+
+    # Keep the embeddings of all loaded bots in one matrix per tag, instead of one per bot.
+    shared_index: bool = False
+
+    # The vector search backend, exact or hnsw (needs hnswlib). With hnsw, the graph is built by
+    # create_index for the tags with at least hnsw_min_nodes nodes, the rest use exact search.
+    vector_backend: str = "exact"
+    hnsw_min_nodes: int = 10000
+    hnsw_m: int = 16
+    hnsw_ef_construction: int = 200
+    hnsw_ef_search: int = 64
+
+    # Keep the vectors of a tag quantized in memory, none, int8 or binary, and re-rank the best
+    # quantized_candidates of them with the full precision vectors from the mapped index file.
+    vector_quantization: dict[str, str] = {"desc": "none", "exemplar": "none"}
+    quantized_candidates: int = 64
+
     skill_arity: int = 1
     llm_device: str = DEVICE
 
@@ -60,6 +94,56 @@ class InferenceConfig(BaseModel):
 
     eval_mode: bool = True
 
+    # Decide exemplar/desc by comparing the logits of true and false in one forward pass,
+    # instead of decoding. Temperature is used to calibrate the resulting probability.
+    skill_scoring: bool = True
+    score_temperature: float = 1.0
+
+    # Look the normalized utterance up in the exact match index of the exemplar templates first,
+    # a hit decides the skill without retrieval or generation.
+    template_fast_path: bool = True
+
+    # Run the exemplar and desc stages as a cascade: the one with fewer prompts that can give some
+    # owner more than threshold votes first, and the other only when the leading owner has no
+    # more than threshold votes, or leads by less than margin.
+    skill_cascade: bool = False
+    cascade_threshold: float = 2.0
+    cascade_margin: float = 1.0
+
+    # For causal models, how many shared prompt prefixes we keep the past_key_values for
+    # (0 disables), and the minimal prefix length in tokens that is worth caching.
+    prefix_cache_size: int = 32
+    prefix_cache_min_length: int = 16
+
+    # Only allow the labels of the mode (true/false, or the yes/no results) when decoding.
+    constrained_decoding: bool = True
+
+    # How many generator outputs we cache by prompt (0 disables), and for how many seconds.
+    decision_cache_size: int = 16384
+    decision_cache_ttl: float = 3600.0
+
+    # Prompts from concurrent requests are collected for up to window seconds, or until
+    # the batch reaches the size, then run through the generator as one padded batch.
+    # Set the window to 0 to call the generator directly.
+    generate_batch_window: float = 0.005
+    generate_batch_size: int = 64
+
+    # The blocking work of the service runs on these threads, the queue is bounded and request
+    # that can not be queued get 503, timeout is the per request deadline in seconds.
+    inference_workers: int = 4
+    inference_queue_size: int = 64
+    inference_timeout: float = 30.0
+
+    # The service evicts the least recently used bots when their indexes together take more
+    # than this many bytes.
+    bot_cache_budget: int = 8 * 1024 * 1024 * 1024
+
+    # The service also keeps at most this many bots loaded.
+    bot_cache_capacity: int = 32
+
+    # The number of processes that build index in the background for the service.
+    index_workers: int = 1
+
     # We will append instance.desc/instance.exemplar to this.
     generator: str = "FftGenerator"
     model: str = "OpenCUI/dug-t5base-0.1"
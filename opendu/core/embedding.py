@@ -1,8 +1,13 @@
+import fcntl
+import hashlib
 import math
-from typing import Any, ClassVar, List
+import os
+import threading
+from typing import Any, Callable, ClassVar, List
 from enum import Enum
 
 import numpy as np
+from lru import LRU
 from llama_index.core.bridge.pydantic import PrivateAttr
 from llama_index.core.base.embeddings.base import BaseEmbedding
 from sentence_transformers import SentenceTransformer
@@ -18,9 +23,149 @@ DESC = "desc"
 EXEMPLAR = "exemplar"
 
 
+#
+# The same utterance is embedded for desc and exemplar retrieval, and short utterances like "yes"
+# repeat across users, so we keep a bounded cache of query embeddings, keyed by model, prompt and
+# the whitespace normalized text. This is shared by the inference threads.
+#
+class QueryEmbeddingCache:
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = LRU(size) if size > 0 else None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split())
+
+    # This embeds the queries that are not in cache with one call to encode.
+    def embed(self, model_name: str, prompt: str, queries: List[str], encode: Callable) -> list[np.ndarray]:
+        texts = [QueryEmbeddingCache.normalize(query) for query in queries]
+        if self.entries is None:
+            return list(encode(texts))
+
+        keys = [(model_name, prompt, text) for text in texts]
+        results = [None] * len(keys)
+        with self.lock:
+            for index, key in enumerate(keys):
+                results[index] = self.entries.get(key)
+        missing = [index for index, result in enumerate(results) if result is None]
+
+        # The same text can show up more than once in a batch, we only encode it once.
+        unique_texts = list(dict.fromkeys(texts[index] for index in missing))
+        if len(unique_texts) != 0:
+            embeddings = {}
+            for text, embedding in zip(unique_texts, encode(unique_texts)):
+                embedding = np.asarray(embedding, dtype=np.float32)
+                embedding.flags.writeable = False
+                embeddings[text] = embedding
+            for index in missing:
+                results[index] = embeddings[texts[index]]
+
+        with self.lock:
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+            for index in missing:
+                self.entries[keys[index]] = results[index]
+        return results
+
+    def stats(self):
+        with self.lock:
+            return {
+                "capacity": self.size,
+                "size": 0 if self.entries is None else len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+#
+# Embeddings of the indexed texts (descriptions and exemplars) only depend on the model, the
+# text prompt and the text, so we keep them on disk, shared across bots and re-indexes. Vectors
+# are appended as float32 to one file, and for each vector we append a fixed size record of
+# sha1 key, offset and dimension to the index file. Vectors are written before their records,
+# and appends take a file lock, so indexing processes can share the cache directory.
+#
+class TextEmbeddingCache:
+    record = np.dtype([("key", "V20"), ("offset", "<u8"), ("dim", "<u4")])
+
+    def __init__(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        self.vectors_path = f"{path}/vectors.bin"
+        self.index_path = f"{path}/index.bin"
+        self.lock = threading.Lock()
+        self.entries: dict[bytes, tuple[int, int]] = {}
+        self.position = 0
+        self.refresh()
+
+    @staticmethod
+    def key(prompt_key: str, text: str) -> bytes:
+        return hashlib.sha1(f"{prompt_key}\0{text}".encode("utf-8")).digest()
+
+    # Picks up the records appended since last time, possibly by other processes.
+    def refresh(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "rb") as file:
+            file.seek(self.position)
+            data = file.read()
+        # A record that is still being written is picked up next time.
+        count = len(data) // TextEmbeddingCache.record.itemsize
+        records = np.frombuffer(data, dtype=TextEmbeddingCache.record, count=count)
+        for key, offset, dim in zip(records["key"], records["offset"].tolist(), records["dim"].tolist()):
+            self.entries[key.tobytes()] = (offset, dim)
+        self.position += count * TextEmbeddingCache.record.itemsize
+
+    def get(self, keys: list[bytes]) -> list[np.ndarray]:
+        with self.lock:
+            if any(key not in self.entries for key in keys):
+                self.refresh()
+            locations = [self.entries.get(key) for key in keys]
+        if all(location is None for location in locations):
+            return [None] * len(keys)
+
+        results = []
+        with open(self.vectors_path, "rb") as file:
+            for location in locations:
+                if location is None:
+                    results.append(None)
+                    continue
+                file.seek(location[0])
+                results.append(np.frombuffer(file.read(4 * location[1]), dtype=np.float32))
+        return results
+
+    def put(self, keys: list[bytes], vectors: list):
+        with self.lock, open(self.index_path, "ab") as index:
+            fcntl.flock(index, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                records = []
+                with open(self.vectors_path, "ab") as file:
+                    for key, vector in zip(keys, vectors):
+                        if key in self.entries:
+                            continue
+                        vector = np.asarray(vector, dtype=np.float32)
+                        self.entries[key] = (file.tell(), len(vector))
+                        records.append((key, file.tell(), len(vector)))
+                        file.write(vector.tobytes())
+                index.write(np.array(records, dtype=TextEmbeddingCache.record).tobytes())
+                index.flush()
+                self.position += len(records) * TextEmbeddingCache.record.itemsize
+            finally:
+                fcntl.flock(index, fcntl.LOCK_UN)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries)}
+
+
 # We reuse the underlying embedding when we can.
 class EmbeddingStore:
     _models: dict[str, SentenceTransformer] = {}
+    _query_cache: QueryEmbeddingCache = None
+    _text_cache: TextEmbeddingCache = None
 
     @classmethod
     def get_model(cls, model_name):
@@ -40,9 +185,27 @@ class EmbeddingStore:
         model_name = RauConfig.get().embedding_model
         model = EmbeddingStore.get_model(RauConfig.get().embedding_model)
         if model_name.startswith("dunzhang"):
-            return StellaEmbeddings(model, kind)
+            return StellaEmbeddings(model, kind, model_name=model_name)
         else:
-            return BaaiEmbeddings(model, kind)
+            return BaaiEmbeddings(model, kind, model_name=model_name)
+
+    @classmethod
+    def get_query_cache(cls) -> QueryEmbeddingCache:
+        if EmbeddingStore._query_cache is None:
+            EmbeddingStore._query_cache = QueryEmbeddingCache(RauConfig.get().query_embedding_cache_size)
+        return EmbeddingStore._query_cache
+
+    # This returns None when the on disk cache is disabled.
+    @classmethod
+    def get_text_cache(cls) -> TextEmbeddingCache:
+        path = RauConfig.get().embedding_cache_path
+        if EmbeddingStore._text_cache is None and path != "":
+            EmbeddingStore._text_cache = TextEmbeddingCache(path)
+        return EmbeddingStore._text_cache
+
+    @classmethod
+    def cache_stats(cls):
+        return EmbeddingStore.get_query_cache().stats()
 
     @classmethod
     def for_description(cls) -> BaseEmbedding:
@@ -55,18 +218,28 @@ class EmbeddingStore:
 
 # This embedding is based on Stella.
 # This embedding has two different modes: one for query, and one for description.
+# Stella is trained with Matryoshka representation, so we can keep only the leading dimensions
+# (and normalize again), both queries and texts are truncated the same way.
 class StellaEmbeddings(BaseEmbedding):
     _instructions: dict[str, str] = PrivateAttr()
     _model: SentenceTransformer = PrivateAttr()
     _query_prompt: dict[str, str] = PrivateAttr()
     _text_prompt: dict[str, str] = PrivateAttr()
+    _dimension: int = PrivateAttr()
 
     def __init__(self, model: SentenceTransformer, kind: str, **kwargs: Any) -> None:
         super().__init__(**kwargs)
         self._model = model
         self._query_prompt = {"prompt_name": "s2p_query" } if kind == DESC else {"prompt_name": "s2s_query" }
         self._text_prompt = {} if kind == DESC else {"prompt_name": "s2s_query" }
+        self._dimension = RauConfig.get().embedding_dimension
 
+    def truncate(self, embeddings):
+        if self._dimension <= 0:
+            return embeddings
+        embeddings = np.asarray(embeddings, dtype=np.float32)[..., :self._dimension]
+        norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
 
     @classmethod
     def class_name(cls) -> str:
@@ -78,15 +251,28 @@ class StellaEmbeddings(BaseEmbedding):
     async def _aget_text_embedding(self, text: str) -> List[float]:
         return self._get_text_embedding(text)
 
+    def encode_queries(self, queries: List[str]):
+        return self.truncate(
+            self._model.encode(queries, normalize_embeddings=True, show_progress_bar=False, **self._query_prompt))
+
     def _get_query_embedding(self, query: str) -> List[float]:
-        return self._model.encode(query, normalize_embeddings=True, show_progress_bar=False, **self._query_prompt)
+        return self._get_query_embeddings([query])[0]
+
+    def _get_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+        return EmbeddingStore.get_query_cache().embed(
+            self.model_name, f"{self._query_prompt['prompt_name']}:{self._dimension}", queries, self.encode_queries)
+
+    # Texts embedded with the same model, prompt and dimension share the on disk cache.
+    def text_prompt_key(self) -> str:
+        return f"{self.model_name}:{self._text_prompt.get('prompt_name', '')}:{self._dimension}"
 
     def _get_text_embedding(self, text: str) -> List[float]:
-        return self._model.encode(text, normalize_embeddings=True, show_progress_bar=False, **self._text_prompt)
+        return self.truncate(
+            self._model.encode(text, normalize_embeddings=True, show_progress_bar=False, **self._text_prompt))
 
     def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
         embeddings = self._model.encode(texts, normalize_embeddings=True, **self._text_prompt)
-        return embeddings.tolist()
+        return self.truncate(embeddings).tolist()
 
 
 # We might want to support embedding from Jina, but it has a CC BY-NC 4.0 license.
@@ -138,8 +324,19 @@ class BaaiEmbeddings(BaseEmbedding):
     async def _aget_text_embedding(self, text: str) -> List[float]:
         return self._get_text_embedding(text)
 
+    def encode_queries(self, queries: List[str]):
+        texts = [self.expand_for_query(query) for query in queries]
+        return self._model.encode(texts, normalize_embeddings=True, show_progress_bar=False)
+
     def _get_query_embedding(self, query: str) -> List[float]:
-        return self._model.encode(self.expand_for_query(query), normalize_embeddings=True)
+        return self._get_query_embeddings([query])[0]
+
+    def _get_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+        return EmbeddingStore.get_query_cache().embed(
+            self.model_name, self._instructions["query"], queries, self.encode_queries)
+
+    def text_prompt_key(self) -> str:
+        return f"{self.model_name}:{self._instructions['key']}"
 
     def _get_text_embedding(self, text: str) -> List[float]:
         return self._model.encode(self.expand_for_content(text), normalize_embeddings=True)
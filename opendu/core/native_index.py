@@ -0,0 +1,161 @@
+# Copyright 2024, OpenCUI
+# Licensed under the Apache License, Version 2.0.
+
+import hashlib
+import json
+import os
+import sys
+import time
+import uuid
+
+import numpy as np
+from llama_index.core.schema import TextNode
+
+from opendu.core.bm25 import save_atomic
+
+
+#
+# The nodes of an index kept in columns instead of as TextNode objects: the ids and each metadata
+# key are lists, and the texts are one utf-8 blob with offsets. The TextNode is only built for the
+# rows that are actually returned by retrieval. A view selects rows in a different order, and can
+# take the text from a metadata column, which is how the keyword search uses the template.
+#
+class NodeTable:
+    def __init__(self, ids, metadata, texts, offsets, excluded_embed, excluded_llm, rows=None, text_column=None):
+        self.ids = ids
+        self.metadata = metadata
+        self.texts = texts
+        self.offsets = offsets
+        self.excluded_embed = excluded_embed
+        self.excluded_llm = excluded_llm
+        self.rows = rows
+        self.text_column = text_column
+
+    @staticmethod
+    def from_nodes(nodes: list[TextNode]):
+        keys = list(dict.fromkeys(key for node in nodes for key in node.metadata.keys()))
+        metadata = {key: [node.metadata.get(key) for node in nodes] for key in keys}
+        blobs = [node.text.encode("utf-8") for node in nodes]
+        offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(blob) for blob in blobs])
+        texts = np.frombuffer(b"".join(blobs), dtype=np.uint8)
+        first = nodes[0] if len(nodes) != 0 else TextNode(text="")
+        return NodeTable(
+            [node.id_ for node in nodes], metadata, texts, offsets,
+            first.excluded_embed_metadata_keys, first.excluded_llm_metadata_keys)
+
+    def select(self, rows: np.ndarray, text_column: str = None):
+        return NodeTable(
+            self.ids, self.metadata, self.texts, self.offsets, self.excluded_embed, self.excluded_llm,
+            rows, text_column)
+
+    def __len__(self):
+        return len(self.ids) if self.rows is None else len(self.rows)
+
+    # This identifies the rows of the table, the files derived from them keep it.
+    def digest(self) -> str:
+        return hashlib.sha1("\n".join(self.ids).encode("utf-8")).hexdigest()
+
+    def __getitem__(self, index: int) -> TextNode:
+        row = int(index if self.rows is None else self.rows[index])
+        # The exemplars without context keep None for context_frame and context_slot.
+        metadata = {key: values[row] for key, values in self.metadata.items()}
+        return TextNode(
+            text=self.text(row) if self.text_column is None else metadata[self.text_column],
+            id_=self.ids[row],
+            metadata=metadata,
+            excluded_embed_metadata_keys=self.excluded_embed,
+            excluded_llm_metadata_keys=self.excluded_llm)
+
+    def text(self, row: int) -> str:
+        return bytes(self.texts[self.offsets[row]:self.offsets[row + 1]]).decode("utf-8")
+
+    # A view shares the columns with the table it is selected from.
+    def resident_size(self) -> int:
+        if self.rows is not None:
+            return np.asarray(self.rows).nbytes
+        columns = sum(sys.getsizeof(value) for values in self.metadata.values() for value in values)
+        return columns + sum(sys.getsizeof(nid) for nid in self.ids) + self.texts.nbytes + self.offsets.nbytes
+
+
+#
+# The opendu index format for one tag: the normalized embedding matrix, the text blob and offsets
+# as npy files opened with memory mapping, and the ids and metadata columns as json. Loading an
+# index does not parse or copy the embeddings, so it takes about the same time for any size.
+# The json is written last, so it marks a complete index. The embedding key records the model,
+# prompt and dimension the embeddings are from.
+# Each save writes its arrays under a new version, and the json names the version, so a load while
+# indexing gets either the old or the new index, never the arrays of one with the nodes of the other.
+#
+class NativeIndex:
+    arrays = ["embeddings", "texts", "offsets"]
+
+    def __init__(self, nodes: NodeTable, embeddings: np.ndarray, embedding_key: str = ""):
+        self.nodes = nodes
+        self.embeddings = embeddings
+        self.embedding_key = embedding_key
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(f"{path}/nodes.json")
+
+    # The index written before the versions has the arrays without suffix.
+    @staticmethod
+    def array_path(path: str, name: str, version: str) -> str:
+        return f"{path}/{name}-{version}.npy" if version != "" else f"{path}/{name}.npy"
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        version = uuid.uuid4().hex
+        arrays = {"embeddings": self.embeddings, "texts": self.nodes.texts, "offsets": self.nodes.offsets}
+        for name in NativeIndex.arrays:
+            save_atomic(NativeIndex.array_path(path, name, version), arrays[name])
+        with open(f"{path}/nodes.json.tmp", "w") as file:
+            json.dump({
+                "ids": self.nodes.ids,
+                "metadata": self.nodes.metadata,
+                "excluded_embed_metadata_keys": self.nodes.excluded_embed,
+                "excluded_llm_metadata_keys": self.nodes.excluded_llm,
+                "embedding_key": self.embedding_key,
+                "version": version,
+                "rows": len(self.nodes.ids),
+                "digest": self.nodes.digest()
+            }, file)
+        os.replace(f"{path}/nodes.json.tmp", f"{path}/nodes.json")
+
+        # The arrays of the earlier versions are no longer named by the json. The loaded indexes
+        # keep their mapping, and a load that read the old json just before retries.
+        for name in os.listdir(path):
+            if name.endswith(".npy") and not name.endswith(f"-{version}.npy"):
+                os.remove(f"{path}/{name}")
+
+    # A load can race with a save of the same index, so it retries a few times.
+    @staticmethod
+    def load(path: str, attempts: int = 3):
+        for attempt in range(attempts):
+            try:
+                return NativeIndex.read(path)
+            except (FileNotFoundError, ValueError):
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(0.1)
+
+    @staticmethod
+    def read(path: str):
+        with open(f"{path}/nodes.json") as file:
+            columns = json.load(file)
+        version = columns.get("version", "")
+        embeddings, texts, offsets = [
+            np.load(NativeIndex.array_path(path, name, version), mmap_mode="r") for name in NativeIndex.arrays
+        ]
+        nodes = NodeTable(
+            columns["ids"], columns["metadata"], texts, offsets,
+            columns["excluded_embed_metadata_keys"], columns["excluded_llm_metadata_keys"])
+
+        # The ids, the rows of the arrays and the digest need to agree.
+        rows = columns.get("rows", len(nodes.ids))
+        if not (rows == len(nodes.ids) == embeddings.shape[0] == len(offsets) - 1):
+            raise ValueError(f"index at {path} has {len(nodes.ids)} ids for {embeddings.shape[0]} rows.")
+        if columns.get("digest", nodes.digest()) != nodes.digest():
+            raise ValueError(f"index at {path} does not match its digest.")
+        return NativeIndex(nodes, embeddings, columns.get("embedding_key", ""))
@@ -2,21 +2,25 @@
 # -*- coding: utf-8 -*-
 import logging
 import shutil
+import weakref
 from collections import defaultdict
 from typing import Callable, List, Optional, cast
 
+import numpy as np
 from llama_index.core import Settings
 from llama_index.core.schema import QueryBundle
-from llama_index.core import VectorStoreIndex
 from llama_index.core import StorageContext, load_index_from_storage
 from llama_index.core.embeddings import BaseEmbedding
 # Retrievers
-from llama_index.core.retrievers import (BaseRetriever, VectorIndexRetriever)
-from llama_index.retrievers.bm25 import BM25Retriever
-from llama_index.core.schema import NodeWithScore, TextNode, BaseNode
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, TextNode, BaseNode, MetadataMode
 
 from opendu.core.annotation import (FrameId, FrameSchema, Schema, CamelToSnake, get_value)
+from opendu.core.ann import HnswIndex
+from opendu.core.bm25 import BM25Postings, KeywordRetriever
 from opendu.core.config import RauConfig
+from opendu.core.native_index import NativeIndex, NodeTable
+from opendu.core.shared_index import SharedMatrix
 from opendu.core import embedding
 
 
@@ -39,7 +43,72 @@ def build_nodes_from_skills(module: str, skills: dict[str, FrameSchema], nodes):
             ))
 
 
+# This loads the index persisted at path, older index that only have the llama_index storage are
+# converted on load. It raises FileNotFoundError if there is no index at path.
+def load_native_index(path: str) -> NativeIndex:
+    if NativeIndex.exists(path):
+        return NativeIndex.load(path)
+
+    try:
+        storage_context = StorageContext.from_defaults(persist_dir=path)
+        embedding_index = load_index_from_storage(storage_context, index_id="embedding")
+    except ValueError as error:
+        raise FileNotFoundError(str(error))
+
+    embedding_dict = embedding_index.vector_store.data.embedding_dict
+    ids = [nid for nid in embedding_dict.keys() if nid in embedding_index.docstore.docs]
+    nodes = [embedding_index.docstore.get_node(nid) for nid in ids]
+    embeddings = np.asarray([embedding_dict[nid] for nid in ids], dtype=np.float32).reshape(len(ids), -1)
+    return NativeIndex(NodeTable.from_nodes(nodes), MatrixVectorRetriever.normalize(embeddings))
+
+
+# This returns node id to (embedded text, embedding) from the index persisted at path, if any,
+# and if it is embedded the same way as embedding_key says.
+def load_persisted_embeddings(path: str, embedding_key: str) -> dict[str, tuple[str, np.ndarray]]:
+    try:
+        index = load_native_index(path)
+    except FileNotFoundError:
+        return {}
+    if index.embedding_key != embedding_key:
+        return {}
+
+    nodes = index.nodes
+    return {
+        nodes.ids[row]: (nodes[row].get_content(metadata_mode=MetadataMode.EMBED), index.embeddings[row])
+        for row in range(len(nodes))
+    }
+
+
+# This looks up the text embeddings in the on disk cache, and embeds the rest in batch and adds
+# them to the cache, it returns the embeddings and the number of cached texts.
+def embed_texts(texts: list[str], embed_model: BaseEmbedding) -> tuple[list, int]:
+    cache = embedding.EmbeddingStore.get_text_cache()
+    if len(texts) == 0:
+        return [], 0
+    if cache is None:
+        return embed_model.get_text_embedding_batch(texts), 0
+
+    keys = [cache.key(embed_model.text_prompt_key(), text) for text in texts]
+    vectors = cache.get(keys)
+    cached = sum(vector is not None for vector in vectors)
+
+    missing = {}
+    for index, vector in enumerate(vectors):
+        if vector is None:
+            missing.setdefault(keys[index], texts[index])
+    if len(missing) != 0:
+        computed = embed_model.get_text_embedding_batch(list(missing.values()))
+        cache.put(list(missing.keys()), computed)
+        computed = dict(zip(missing.keys(), computed))
+        vectors = [computed[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+    return vectors, cached
+
+
 # This is used to create the retriever so that we can get dynamic exemplars into understanding.
+# When there is already an index at the path, we diff against it: the nodes with the same id and
+# the same embedded text keep their embedding, only added and changed nodes are embedded, and
+# the nodes no longer in the list are dropped. Added and changed nodes are looked up in the shared
+# on disk embedding cache before we embed them. The index is saved in the native format.
 def create_index(base: str, tag: str, nodes: list[TextNode],
                  embedding: BaseEmbedding):
     path = f"{base}/{tag}/"
@@ -48,20 +117,49 @@ def create_index(base: str, tag: str, nodes: list[TextNode],
     Settings.llm_predictor = None
     Settings.embed_model = embedding
 
+    persisted = load_persisted_embeddings(path, embedding.text_prompt_key())
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    vectors = [None] * len(nodes)
+    for index, node in enumerate(nodes):
+        previous = persisted.get(node.id_)
+        if previous is not None and previous[0] == texts[index]:
+            vectors[index] = previous[1]
+    missing = [index for index, vector in enumerate(vectors) if vector is None]
+    removed = len(persisted.keys() - {node.id_ for node in nodes})
 
-    storage_context = StorageContext.from_defaults()
-    print(f"Add {len(nodes)} nodes to {tag}")
-    storage_context.docstore.add_documents(nodes)
+    computed, cached = embed_texts([texts[index] for index in missing], embedding)
+    for index, vector in zip(missing, computed):
+        vectors[index] = vector
+
+    reused = len(nodes) - len(missing)
+    print(f"Add {len(nodes)} nodes to {tag}, embed {len(missing) - cached}, reuse {reused}, cached {cached}, remove {removed}")
+
+    embeddings = np.stack([np.asarray(vector, dtype=np.float32) for vector in vectors]) if nodes else np.zeros((0, 0), dtype=np.float32)
+    embeddings = MatrixVectorRetriever.normalize(embeddings)
+    table = NodeTable.from_nodes(nodes)
+    # The old graph does not match the new rows, the loader also checks the digest.
+    HnswIndex.remove(path)
+    NativeIndex(table, embeddings, embedding.text_prompt_key()).save(path)
+
+    # The graph is only worth it for the large tags.
+    config = RauConfig.get()
+    if config.vector_backend == "hnsw" and len(nodes) >= config.hnsw_min_nodes:
+        HnswIndex.build(embeddings).save(path, table.digest())
 
-    try:
-        embedding_index = VectorStoreIndex(
-            nodes,
-            storage_context=storage_context)
-        embedding_index.set_index_id("embedding")
-        embedding_index.storage_context.persist(persist_dir=path)
-    except Exception as e:
-        print(str(e))
-        shutil.rmtree(path, ignore_errors=True)
+
+# When all the nodes of a tag are removed, the index for the tag (with its bm25 postings and hnsw
+# graph) is removed too, instead of serving the nodes of the last indexing.
+def remove_index(base: str, tag: str):
+    shutil.rmtree(f"{base}/{tag}", ignore_errors=True)
+
+
+# For exemplar, keyword search uses the original template instead of the text with slot names,
+# to reduce the casual match related to slot name.
+def build_keyword_index(base: str, tag: str, nodes: list[TextNode]):
+    postings = BM25Postings.build(
+        [node.id_ for node in nodes],
+        [node.metadata["template"] for node in nodes])
+    postings.save(f"{base}/{tag}/bm25")
 
 
 def build_desc_index(module: str, dsc: Schema, output: str,
@@ -71,22 +169,258 @@ def build_desc_index(module: str, dsc: Schema, output: str,
     create_index(output, "desc", desc_nodes, embedding)
 
 
+# Cosine and BM25 scores are on different scales, so before we add them up, the scores of each
+# result list can be replaced by reciprocal rank (rrf), or normalized by min-max or z-score.
+# With sum, the raw scores are added.
+def fusion_scores(results: list[NodeWithScore], mode: str) -> list[float]:
+    scores = np.asarray([ns.score for ns in results], dtype=np.float64)
+    if len(results) == 0 or mode == "sum":
+        return scores.tolist()
+    if mode == "rrf":
+        ranks = np.empty(len(scores), dtype=np.int64)
+        ranks[np.argsort(-scores, kind="stable")] = np.arange(len(scores))
+        return (1.0 / (RauConfig.get().rrf_k + ranks + 1)).tolist()
+    if mode == "minmax":
+        spread = scores.max() - scores.min()
+        return ((scores - scores.min()) / spread if spread > 0 else np.ones_like(scores)).tolist()
+    if mode == "zscore":
+        std = scores.std()
+        return ((scores - scores.mean()) / std if std > 0 else np.zeros_like(scores)).tolist()
+    raise ValueError(f"unknown fusion mode {mode}.")
+
+
 # This merge the result.
-def merge_nodes(nodes0: list[NodeWithScore], nodes1: list[NodeWithScore])-> list[NodeWithScore]:
+def merge_nodes(nodes0: list[NodeWithScore], nodes1: list[NodeWithScore], mode: str = None)-> list[NodeWithScore]:
+    mode = RauConfig.get().fusion_mode if mode is None else mode
     nodes = {}
     scores = {}
-    for ns in nodes0 + nodes1:
-        if ns.node.id_ in nodes:
-            scores[ns.node.id_] += ns.score
-        else:
-            nodes[ns.node.id_] = ns.node
-            scores[ns.node.id_] = ns.score
+    for results in [nodes0, nodes1]:
+        for ns, score in zip(results, fusion_scores(results, mode)):
+            if ns.node.id_ in nodes:
+                scores[ns.node.id_] += score
+            else:
+                nodes[ns.node.id_] = ns.node
+                scores[ns.node.id_] = score
 
     res = [NodeWithScore(node=nodes[nid], score=scores[nid]) for nid in nodes.keys()]
     return sorted(res, key=lambda x: x.score, reverse=True)
 
 
 
+#
+# This keeps all the node embeddings of a tag as one contiguous matrix, so that scoring a query
+# is a single matmul, and top-k is an argpartition over the scores, instead of the python loop
+# over the embedding lists in SimpleVectorStore. Rows are normalized, so the score is cosine.
+# The embeddings from the native index are already normalized, and used as they are mapped.
+#
+class MatrixVectorRetriever(BaseRetriever):
+    # Queries are scored in chunks, so that the score matrix stays small for large batches.
+    chunk_size = 256
+    # The rows not in float32 are upcast in chunks of this many rows for scoring, as numpy has
+    # no BLAS for float16, and its own matmul is many times slower.
+    row_chunk = 65536
+
+    def __init__(self, nodes: NodeTable, embeddings: np.ndarray, embed_model: BaseEmbedding, topk: int, normalized=False):
+        super().__init__()
+        self._nodes = nodes
+        self._embeddings = embeddings if normalized else MatrixVectorRetriever.normalize(embeddings)
+        self._embed_model = embed_model
+        self._topk = topk
+
+    # The rows are kept in the configured dtype, the queries are always float32.
+    @staticmethod
+    def normalize(embeddings: np.ndarray, dtype=None) -> np.ndarray:
+        dtype = np.dtype(RauConfig.get().vector_dtype if dtype is None else dtype)
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return np.ascontiguousarray(matrix / norms, dtype=dtype)
+
+    @staticmethod
+    def from_native(index: NativeIndex, embed_model: BaseEmbedding, topk: int):
+        normalized = index.embeddings.dtype == np.dtype(RauConfig.get().vector_dtype)
+        return MatrixVectorRetriever(index.nodes, index.embeddings, embed_model, topk, normalized)
+
+    # The hnsw graph is used when it is built for the tag, then the quantized vectors if configured
+    # for the tag, otherwise we search all the rows.
+    @staticmethod
+    def load(index: NativeIndex, path: str, tag: str, embed_model: BaseEmbedding, topk: int):
+        if RauConfig.get().vector_backend == "hnsw" and HnswIndex.exists(path):
+            if HnswIndex.matches(path, index.nodes.digest()):
+                ann = HnswIndex.load(path, index.embeddings.shape[1])
+                return HnswVectorRetriever(index.nodes, index.embeddings, ann, embed_model, topk)
+            logging.warning(f"hnsw graph at {path} is not built for the current index, fall back to the matrix search.")
+        quantization = RauConfig.get().vector_quantization.get(tag, "none")
+        if quantization != "none":
+            candidates = RauConfig.get().quantized_candidates
+            return QuantizedVectorRetriever(index.nodes, index.embeddings, quantization, candidates, embed_model, topk)
+        if RauConfig.get().shared_index:
+            return SharedMatrixRetriever(index.nodes, index.embeddings, SharedMatrix.for_tag(tag), embed_model, topk)
+        return MatrixVectorRetriever.from_native(index, embed_model, topk)
+
+    def embeddings(self) -> np.ndarray:
+        return self._embeddings
+
+    def resident_size(self) -> int:
+        return self._embeddings.nbytes + self._nodes.resident_size()
+
+    def top_k(self, scores: np.ndarray) -> list[NodeWithScore]:
+        k = min(self._topk, scores.shape[0])
+        if k == 0:
+            return []
+        indexes = np.argpartition(-scores, k - 1)[:k]
+        indexes = indexes[np.argsort(-scores[indexes])]
+        return [NodeWithScore(node=self._nodes[index], score=float(scores[index])) for index in indexes]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        if query_bundle.embedding is None:
+            query_bundle.embedding = self._embed_model.get_agg_embedding_from_queries(
+                query_bundle.embedding_strs)
+        return self.search(MatrixVectorRetriever.normalize([query_bundle.embedding], np.float32))[0]
+
+    # All the queries are embedded in one encode call.
+    def retrieve_batch(self, queries: list[str]) -> list[list[NodeWithScore]]:
+        if len(queries) == 0:
+            return []
+        return self.search(MatrixVectorRetriever.normalize(self._embed_model._get_query_embeddings(queries), np.float32))
+
+    # This returns the top k for each of the normalized query embeddings.
+    def search(self, embeddings: np.ndarray) -> list[list[NodeWithScore]]:
+        if len(self._nodes) == 0:
+            return [[] for _ in embeddings]
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        matrix = self.embeddings()
+        results = []
+        for start in range(0, len(embeddings), MatrixVectorRetriever.chunk_size):
+            results.extend(self.top_k(row) for row in self.scores(embeddings[start:start + MatrixVectorRetriever.chunk_size], matrix))
+        return results
+
+    @staticmethod
+    def scores(queries: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+        if matrix.dtype == np.float32:
+            return queries @ matrix.T
+        return np.concatenate([
+            queries @ matrix[start:start + MatrixVectorRetriever.row_chunk].astype(np.float32).T
+            for start in range(0, matrix.shape[0], MatrixVectorRetriever.row_chunk)
+        ], axis=1)
+
+
+#
+# The same as MatrixVectorRetriever, but the rows live in the shared matrix of the tag, and are
+# released from it when this retriever is garbage collected, for example after the bot is evicted.
+#
+class SharedMatrixRetriever(MatrixVectorRetriever):
+    def __init__(self, nodes: NodeTable, embeddings: np.ndarray, shared: SharedMatrix, embed_model: BaseEmbedding, topk: int):
+        if embeddings.dtype != shared.dtype:
+            embeddings = MatrixVectorRetriever.normalize(embeddings)
+        super().__init__(nodes, None, embed_model, topk, normalized=True)
+        self._shared = shared
+        self._token = shared.register(embeddings)
+        weakref.finalize(self, shared.release, self._token)
+
+    def embeddings(self) -> np.ndarray:
+        return self._shared.rows(self._token)
+
+    # Each bot counts its share of the shared matrix, so the bot budget also bounds the matrix.
+    def resident_size(self) -> int:
+        return self._shared.share(self._token) + self._nodes.resident_size()
+
+
+#
+# The same as MatrixVectorRetriever, but only the quantized vectors are kept in memory: int8 with
+# a scale for each dimension, or binary with one bit for the sign of each dimension, compared by
+# hamming distance. The best candidates by the quantized score are re-ranked with the normalized
+# vectors read from the mapped index file, so the scores are still exact cosine.
+#
+class QuantizedVectorRetriever(MatrixVectorRetriever):
+    # Queries are scored in small chunks, since the quantized scores cover all the rows.
+    query_chunk = 32
+    # The int8 codes are converted to float in chunks of rows.
+    row_chunk = 16384
+    popcount = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+    def __init__(self, nodes: NodeTable, embeddings: np.ndarray, mode: str, candidates: int, embed_model: BaseEmbedding, topk: int):
+        super().__init__(nodes, embeddings, embed_model, topk, normalized=True)
+        if mode not in {"int8", "binary"}:
+            raise ValueError(f"unknown vector quantization {mode}.")
+        self._mode = mode
+        self._candidates = max(candidates, topk)
+        chunks = [
+            np.asarray(embeddings[start:start + QuantizedVectorRetriever.row_chunk])
+            for start in range(0, len(nodes), QuantizedVectorRetriever.row_chunk)
+        ]
+        self._scale = None
+        if mode == "int8" and len(chunks) != 0:
+            peaks = np.max([np.abs(chunk).max(axis=0) for chunk in chunks], axis=0).astype(np.float32)
+            self._scale = np.maximum(peaks, 1e-6) / 127.0
+        self._codes = np.concatenate([self.quantize(chunk) for chunk in chunks]) if len(chunks) != 0 else None
+
+    def quantize(self, embeddings: np.ndarray) -> np.ndarray:
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self._mode == "int8":
+            return np.round(embeddings / self._scale).astype(np.int8)
+        return np.packbits(embeddings > 0, axis=1)
+
+    # The full precision rows are only read for re-ranking.
+    def resident_size(self) -> int:
+        codes = 0 if self._codes is None else self._codes.nbytes
+        return codes + self._nodes.resident_size()
+
+    # This returns the quantized scores of all rows for each query, higher is better.
+    def approximate(self, queries: np.ndarray) -> np.ndarray:
+        if self._mode == "int8":
+            scaled = queries * self._scale
+            return np.concatenate([
+                scaled @ self._codes[start:start + QuantizedVectorRetriever.row_chunk].astype(np.float32).T
+                for start in range(0, self._codes.shape[0], QuantizedVectorRetriever.row_chunk)
+            ], axis=1)
+        bits = self.quantize(queries)
+        return -np.stack([
+            QuantizedVectorRetriever.popcount[np.bitwise_xor(self._codes, query)].sum(axis=1, dtype=np.int32)
+            for query in bits
+        ])
+
+    def rerank(self, query: np.ndarray, scores: np.ndarray) -> list[NodeWithScore]:
+        k = min(self._candidates, scores.shape[0])
+        rows = np.sort(np.argpartition(-scores, k - 1)[:k])
+        exact = np.asarray(self._embeddings[rows], dtype=np.float32) @ query
+        best = np.argsort(-exact, kind="stable")[:self._topk]
+        return [NodeWithScore(node=self._nodes[int(rows[index])], score=float(exact[index])) for index in best]
+
+    def search(self, embeddings: np.ndarray) -> list[list[NodeWithScore]]:
+        if len(self._nodes) == 0:
+            return [[] for _ in embeddings]
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        results = []
+        for start in range(0, len(embeddings), QuantizedVectorRetriever.query_chunk):
+            queries = embeddings[start:start + QuantizedVectorRetriever.query_chunk]
+            results.extend(self.rerank(query, scores) for query, scores in zip(queries, self.approximate(queries)))
+        return results
+
+
+#
+# The same as MatrixVectorRetriever, but the top k comes from the hnsw graph, so it is approximate.
+# The mapped embeddings are kept but not touched by search.
+#
+class HnswVectorRetriever(MatrixVectorRetriever):
+    def __init__(self, nodes: NodeTable, embeddings: np.ndarray, ann: HnswIndex, embed_model: BaseEmbedding, topk: int):
+        super().__init__(nodes, embeddings, embed_model, topk, normalized=True)
+        assert len(ann) == len(nodes)
+        self._ann = ann
+
+    def resident_size(self) -> int:
+        return self._ann.resident_size() + self._nodes.resident_size()
+
+    def search(self, embeddings: np.ndarray) -> list[list[NodeWithScore]]:
+        if len(self._nodes) == 0:
+            return [[] for _ in embeddings]
+        rows, scores = self._ann.search(embeddings, self._topk)
+        return [
+            [NodeWithScore(node=self._nodes[int(row)], score=float(score)) for row, score in zip(row_ids, row_scores)]
+            for row_ids, row_scores in zip(rows, scores)
+        ]
+
+
 class EmbeddingRetriever(BaseRetriever):
     """Custom retriever that performs both semantic search."""
     @staticmethod
@@ -96,16 +430,8 @@ class EmbeddingRetriever(BaseRetriever):
         Settings.embed_model=embedding.EmbeddingStore.get_embedding_by_task(tag)
 
         try:
-            storage_context = StorageContext.from_defaults(
-                persist_dir=f"{path}/{tag}/")
-
-            embedding_index = load_index_from_storage(
-                storage_context,
-                index_id="embedding")
-
-            vector_retriever = VectorIndexRetriever(
-                index=embedding_index,
-                similarity_top_k=topk)
+            index = load_native_index(f"{path}/{tag}/")
+            vector_retriever = MatrixVectorRetriever.load(index, f"{path}/{tag}/", tag, Settings.embed_model, topk)
 
             return EmbeddingRetriever(vector_retriever)
         except (ZeroDivisionError, FileNotFoundError) as error:
@@ -115,10 +441,16 @@ class EmbeddingRetriever(BaseRetriever):
     def __init__(self, vec_retriever):
         self._vector_retriever = vec_retriever
 
+    def resident_size(self) -> int:
+        return self._vector_retriever.resident_size()
+
     def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
         """Retrieve nodes given query."""
         return self._vector_retriever.retrieve(query_bundle)
 
+    def retrieve_batch(self, queries: list[str]) -> list[list[NodeWithScore]]:
+        return self._vector_retriever.retrieve_batch(queries)
+
 #
 class HybridRetriever(BaseRetriever):
     """Custom retriever that performs both semantic search and hybrid search."""
@@ -129,35 +461,24 @@ class HybridRetriever(BaseRetriever):
         Settings.embed_model=embedding.EmbeddingStore.get_embedding_by_task(tag)
 
         try:
-            storage_context = StorageContext.from_defaults(
-                persist_dir=f"{path}/{tag}/")
-
-            embedding_index = load_index_from_storage(
-                storage_context,
-                index_id="embedding")
+            index = load_native_index(f"{path}/{tag}/")
+            vector_retriever = MatrixVectorRetriever.load(index, f"{path}/{tag}/", tag, Settings.embed_model, topk)
 
-            vector_retriever = VectorIndexRetriever(
-                index=embedding_index,
-                similarity_top_k=topk)
+            # The postings are built at index time, after the index. For older index without them,
+            # or when they are not (yet) written for the current nodes, they are built here.
+            postings_path = f"{path}/{tag}/bm25"
+            postings = BM25Postings.load(postings_path) if BM25Postings.exists(postings_path) else None
+            if postings is None or list(postings.node_ids) != list(index.nodes.ids):
+                postings = BM25Postings.build(index.nodes.ids, index.nodes.metadata.get("template", []))
 
             # For exemplar, the embedding and keyword need to use different
             # The reason we use original template is to reduce the casual match
             # related to slot name, since the original template use slot_label.
-            keywords_nodes = []
-            raw_nodes = list(embedding_index.docstore.docs.values())
-            for node in raw_nodes:
-                keywords_nodes.append(
-                    TextNode(
-                        text=node.metadata["template"],
-                        id_=node.id_,
-                        metadata=node.metadata,
-                        excluded_embed_metadata_keys=["owner", "template_without_slot", "context_frame", "context_slot", "owner_mode", "template"],
-                    )
-                )
-
-            # For now, we do index everytime we restart the inference.
-            keyword_retriever = BM25Retriever.from_defaults(
-                nodes=keywords_nodes, similarity_top_k=topk)
+            rows = {nid: row for row, nid in enumerate(index.nodes.ids)}
+            keywords_nodes = index.nodes.select(
+                np.asarray([rows[nid] for nid in postings.node_ids], dtype=np.int64), "template")
+
+            keyword_retriever = KeywordRetriever(postings, keywords_nodes, topk)
             return HybridRetriever(vector_retriever, keyword_retriever)
         except (ZeroDivisionError, FileNotFoundError) as error:
             print(error)
@@ -167,9 +488,17 @@ class HybridRetriever(BaseRetriever):
         self._vector_retriever = vec_retriever
         self._keyword_retriever = word_retriever
 
+    def resident_size(self) -> int:
+        return self._vector_retriever.resident_size() + self._keyword_retriever.resident_size()
+
+    # The slot query like <slot> is only searched by keyword.
+    @staticmethod
+    def is_keyword_only(query: str):
+        return query.startswith("<") and query.endswith(">")
+
     def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
         """Retrieve nodes given query."""
-        if not query_bundle.query_str.startswith("<") or not query_bundle.query_str.endswith(">"):
+        if not HybridRetriever.is_keyword_only(query_bundle.query_str):
             print("hybrid search")
             vector_nodes = self._vector_retriever.retrieve(query_bundle)
             keyword_nodes = self._keyword_retriever.retrieve(query_bundle)
@@ -178,6 +507,14 @@ class HybridRetriever(BaseRetriever):
             print("key word only search")
             return self._keyword_retriever.retrieve(query_bundle)
 
+    def retrieve_batch(self, queries: list[str]) -> list[list[NodeWithScore]]:
+        results = self._keyword_retriever.retrieve_batch(queries)
+        hybrids = [index for index, query in enumerate(queries) if not HybridRetriever.is_keyword_only(query)]
+        vector_results = self._vector_retriever.retrieve_batch([queries[index] for index in hybrids])
+        for index, vector_nodes in zip(hybrids, vector_results):
+            results[index] = merge_nodes(vector_nodes, results[index])
+        return results
+
 
 def dedup_nodes(old_results: list[TextNode], with_mode, arity=1):
     new_results = []
@@ -219,6 +556,11 @@ class ContextRetriever:
         self.arity = RauConfig.get().exemplar_retrieve_arity
         self.extended_mode = False
 
+    # The schema is small compared to the indexes, so we only count the retrievers.
+    def resident_size(self) -> int:
+        retrievers = [self.desc_retriever, self.exemplar_retriever]
+        return sum(retriever.resident_size() for retriever in retrievers if retriever is not None)
+
     def retrieve_by_desc(self, query):
         # The goal here is to find the combined descriptions and exemplars.
         return self.desc_retriever.retrieve(query)
@@ -243,25 +585,30 @@ class ContextRetriever:
             slot_nodes.extend(filter(match, nodes))
         return slot_nodes
 
+    def retrieve_by_exemplar_batch(self, queries):
+        return self.exemplar_retriever.retrieve_batch(queries)
+
     def __call__(self, query):
         # The goal here is to find the combined descriptions and exemplars.
-        if self.desc_retriever is not None:
-            desc_nodes = [
-                item.node for item in self.desc_retriever.retrieve(query)
-            ]
-        else:
-            desc_nodes = []
+        desc_results = self.desc_retriever.retrieve(query) if self.desc_retriever is not None else []
+        exemplar_results = self.exemplar_retriever.retrieve(query) if self.exemplar_retriever is not None else []
+        return self.collect(desc_results, exemplar_results)
 
-        if self.exemplar_retriever is not None:
-            exemplar_nodes = self.exemplar_retriever.retrieve(query)
-            original_size = len(exemplar_nodes)
+    # This returns the same (skills, exemplar_nodes) for each query as calling one at a time,
+    # but embeds all queries in one call, and does the vector and keyword search in batch.
+    def retrieve_batch(self, queries: list[str]):
+        empties = [[] for _ in queries]
+        desc_results = self.desc_retriever.retrieve_batch(queries) if self.desc_retriever is not None else empties
+        exemplar_results = self.exemplar_retriever.retrieve_batch(queries) if self.exemplar_retriever is not None else empties
+        return [self.collect(desc, exemplar) for desc, exemplar in zip(desc_results, exemplar_results)]
 
-            slot_nodes = []
-            exemplar_nodes = [
-                item.node for item in merge_nodes(exemplar_nodes, slot_nodes)
-            ][0:original_size]
-        else:
-            exemplar_nodes = []
+    def collect(self, desc_results: list[NodeWithScore], exemplar_results: list[NodeWithScore]):
+        desc_nodes = [item.node for item in desc_results]
+
+        slot_nodes = []
+        exemplar_nodes = [
+            item.node for item in merge_nodes(exemplar_results, slot_nodes)
+        ][0:len(exemplar_results)]
 
         # TODO: Figure out how to better use expectations filter the result set.
 
@@ -0,0 +1,118 @@
+# Copyright 2024, OpenCUI
+# Licensed under the Apache License, Version 2.0.
+
+import threading
+
+import numpy as np
+
+from opendu.core.config import RauConfig
+
+
+#
+# When the service hosts many bots with the same embedding model, the embeddings of all the bots
+# for a tag can live in one matrix, where each bot owns a contiguous range of rows. Registering a
+# bot appends its rows (the matrix grows by doubling), so loading a bot is a copy into the shared
+# matrix instead of a new allocation, and scoring for a bot is on the view of its rows.
+# Each registration gets its own range and token, so a reindexed bot can be registered while the
+# old index is still serving, and the old rows are garbage once released, until the next compaction.
+#
+class SharedMatrix:
+    _matrices: dict[str, "SharedMatrix"] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, tag: str):
+        self.tag = tag
+        self.dtype = np.dtype(RauConfig.get().vector_dtype)
+        self.matrix = None
+        self.used = 0
+        self.ranges: dict[int, tuple[int, int]] = {}
+        self.tokens = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_tag(cls, tag: str) -> "SharedMatrix":
+        with SharedMatrix._lock:
+            if tag not in SharedMatrix._matrices:
+                SharedMatrix._matrices[tag] = SharedMatrix(tag)
+            return SharedMatrix._matrices[tag]
+
+    @classmethod
+    def all_stats(cls):
+        with SharedMatrix._lock:
+            matrices = list(SharedMatrix._matrices.values())
+        return {matrix.tag: matrix.stats() for matrix in matrices}
+
+    # This copies the normalized embeddings of a bot in, and returns the token of the registration.
+    def register(self, embeddings: np.ndarray) -> int:
+        with self.lock:
+            count = embeddings.shape[0]
+            self.tokens += 1
+            if count == 0:
+                self.ranges[self.tokens] = (0, 0)
+                return self.tokens
+
+            if self.matrix is None:
+                self.matrix = np.zeros((max(count, 1024), embeddings.shape[1]), dtype=self.dtype)
+            if embeddings.shape[1] != self.matrix.shape[1]:
+                raise ValueError(f"dimension {embeddings.shape[1]} does not match {self.matrix.shape[1]} of {self.tag}.")
+
+            if self.garbage() > self.live():
+                self.compact()
+            self.reserve(self.used + count)
+            self.matrix[self.used:self.used + count] = embeddings
+            self.ranges[self.tokens] = (self.used, self.used + count)
+            self.used += count
+            return self.tokens
+
+    def release(self, token: int):
+        with self.lock:
+            self.ranges.pop(token, None)
+
+    # The view stays valid even if the matrix is reallocated or compacted afterwards.
+    def rows(self, token: int) -> np.ndarray:
+        with self.lock:
+            start, end = self.ranges[token]
+            return self.matrix[start:end]
+
+    # The bytes of the matrix in proportion to the rows of the registration, including the spare
+    # capacity and the garbage, so the shares of all the registrations add up to the matrix.
+    def share(self, token: int) -> int:
+        with self.lock:
+            start, end = self.ranges.get(token, (0, 0))
+            live = self.live()
+            if self.matrix is None or live == 0:
+                return 0
+            return self.matrix.nbytes * (end - start) // live
+
+    def live(self) -> int:
+        return sum(end - start for start, end in self.ranges.values())
+
+    def garbage(self) -> int:
+        return self.used - self.live()
+
+    def reserve(self, size: int):
+        if size <= self.matrix.shape[0]:
+            return
+        matrix = np.zeros((max(size, 2 * self.matrix.shape[0]), self.matrix.shape[1]), dtype=self.dtype)
+        matrix[:self.used] = self.matrix[:self.used]
+        self.matrix = matrix
+
+    def compact(self):
+        matrix = np.zeros_like(self.matrix)
+        used = 0
+        for token, (start, end) in list(self.ranges.items()):
+            matrix[used:used + end - start] = self.matrix[start:end]
+            self.ranges[token] = (used, used + end - start)
+            used += end - start
+        self.matrix = matrix
+        self.used = used
+
+    def stats(self):
+        with self.lock:
+            return {
+                "ranges": len(self.ranges),
+                "rows": self.live(),
+                "garbage": self.garbage(),
+                "capacity": 0 if self.matrix is None else self.matrix.shape[0],
+                "bytes": 0 if self.matrix is None else self.matrix.nbytes
+            }
@@ -0,0 +1,124 @@
+# Copyright 2024, OpenCUI
+# Licensed under the Apache License, Version 2.0.
+
+import json
+import os
+import re
+
+from opendu.core.annotation import (EntityMetas, ExemplarStore, get_value)
+
+
+#
+# This puts the utterance and the exemplar templates into the same normal form: the slots in the
+# template and the values the list recognizers find in the utterance both become <entity>, then
+# everything is lower cased, the punctuation is removed and the spaces are collapsed.
+#
+class TemplateNormalizer:
+    slot_pattern = re.compile(r"<(.+?)>")
+    punctuation = re.compile(r"[^\w\s<>]")
+    spaces = re.compile(r"\s+")
+    non_word = re.compile(r"\W")
+
+    def __init__(self, expressions: dict[str, str], slots: dict[str, str]):
+        self.expressions = expressions
+        self.slots = slots
+        # Longer expressions first, so that "new york city" is not matched as "new york".
+        keys = sorted(expressions.keys(), key=len, reverse=True)
+        self.pattern = re.compile(r"\b(" + "|".join(map(re.escape, keys)) + r")\b") if len(keys) != 0 else None
+
+    @staticmethod
+    def from_recognizers(recognizers: EntityMetas):
+        if recognizers is None:
+            return TemplateNormalizer({}, {})
+        expressions = {
+            expression.lower(): name
+            for name, info in recognizers.recognizers.items()
+            for instance in info.instances
+            for expression in instance.expressions
+        }
+        return TemplateNormalizer(expressions, dict(recognizers.slots))
+
+    # The entity names are capitalized, so the placeholder needs to be in the normal form too.
+    @staticmethod
+    def placeholder(name: str) -> str:
+        return f"<{TemplateNormalizer.non_word.sub('', name.lower())}>"
+
+    def normalize(self, text: str) -> str:
+        text = text.lower()
+        if self.pattern is not None:
+            text = self.pattern.sub(lambda match: self.placeholder(self.expressions[match.group(1)]), text)
+        text = TemplateNormalizer.punctuation.sub(" ", text)
+        return TemplateNormalizer.spaces.sub(" ", text).strip()
+
+    # This returns None when some slot in the template has no recognizer, as no utterance can match it.
+    def normalize_template(self, template: str):
+        labels = TemplateNormalizer.slot_pattern.findall(template)
+        if any(label not in self.slots for label in labels):
+            return None
+        return self.normalize(TemplateNormalizer.slot_pattern.sub(lambda match: f" {self.placeholder(self.slots[match.group(1)])} ", template))
+
+
+#
+# The exact match index from the normalized template to its exemplar, for the utterances that are
+# (almost) the same as some exemplar. It is built at index time, and a hit decides the skill without
+# embedding, retrieval or generation. Only the normal exemplars without context are indexed, and the
+# templates that normalize to the same text for different owners are left out.
+#
+class TemplateIndex:
+    file = "templates.json"
+
+    def __init__(self, normalizer: TemplateNormalizer, templates: dict[str, dict]):
+        self.normalizer = normalizer
+        self.templates = templates
+
+    @staticmethod
+    def build(store: ExemplarStore, recognizers: EntityMetas):
+        normalizer = TemplateNormalizer.from_recognizers(recognizers)
+        templates = {}
+        ambiguous = set()
+        for owner, exemplars in store.items():
+            for exemplar in exemplars:
+                if get_value(exemplar, "owner_mode", "normal") != "normal":
+                    continue
+                if get_value(exemplar, "context_frame", None) is not None:
+                    continue
+                key = normalizer.normalize_template(exemplar["template"])
+                if key is None or key == "":
+                    continue
+                if key in templates and templates[key]["owner"] != owner:
+                    ambiguous.add(key)
+                templates[key] = {
+                    "owner": owner,
+                    "template": exemplar["template"],
+                    "context_frame": None,
+                    "context_slot": None,
+                    "owner_mode": "normal"
+                }
+        return TemplateIndex(normalizer, {key: value for key, value in templates.items() if key not in ambiguous})
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(f"{path}/{TemplateIndex.file}")
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        with open(f"{path}/{TemplateIndex.file}.tmp", "w") as file:
+            json.dump({
+                "expressions": self.normalizer.expressions,
+                "slots": self.normalizer.slots,
+                "templates": self.templates
+            }, file)
+        os.replace(f"{path}/{TemplateIndex.file}.tmp", f"{path}/{TemplateIndex.file}")
+
+    @staticmethod
+    def load(path: str):
+        with open(f"{path}/{TemplateIndex.file}") as file:
+            content = json.load(file)
+        return TemplateIndex(TemplateNormalizer(content["expressions"], content["slots"]), content["templates"])
+
+    # This returns the metadata of the matching exemplar, or None.
+    def match(self, utterance: str):
+        return self.templates.get(self.normalizer.normalize(utterance))
+
+    def __len__(self):
+        return len(self.templates)
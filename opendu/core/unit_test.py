@@ -0,0 +1,55 @@
+import json
+import tempfile
+import unittest
+
+import numpy as np
+from llama_index.core.schema import TextNode
+
+from opendu.core.annotation import EntityMetas, ExemplarStore
+from opendu.core.native_index import NativeIndex, NodeTable
+from opendu.core.template_index import TemplateIndex
+from opendu.inference.intent_detector import node_to_exemplar
+
+
+class NativeIndexTest(unittest.TestCase):
+    def testRoundTrip(self):
+        metadata = {
+            "owner": "OrderFood",
+            "template": "order food",
+            "context_frame": None,
+            "context_slot": None,
+            "owner_mode": "normal"
+        }
+        node = TextNode(
+            text="order food",
+            id_="order",
+            metadata=metadata,
+            excluded_embed_metadata_keys=list(metadata.keys()))
+        path = tempfile.mkdtemp()
+        NativeIndex(NodeTable.from_nodes([node]), np.ones((1, 4), dtype=np.float32)).save(path)
+
+        loaded = NativeIndex.load(path).nodes[0]
+        self.assertEqual(loaded.metadata, metadata)
+        self.assertEqual(node_to_exemplar(loaded), node_to_exemplar(node))
+
+
+class TemplateIndexTest(unittest.TestCase):
+    def testSlotValues(self):
+        with open("./examples/restaurant/exemplars.json") as file:
+            exemplars = ExemplarStore(**json.load(file))
+        with open("./examples/restaurant/recognizers.json") as file:
+            recognizers = EntityMetas(**json.load(file))
+        path = tempfile.mkdtemp()
+        TemplateIndex.build(exemplars, recognizers).save(path)
+        templates = TemplateIndex.load(path)
+
+        meta = templates.match("I'd like to order some Pizza")
+        self.assertIsNotNone(meta)
+        self.assertEqual(meta["owner"], "OrderFood")
+        self.assertEqual(meta["template"], "I'd like to order some <category>.")
+        self.assertEqual(templates.match("Order food!")["owner"], "OrderFood")
+        self.assertIsNone(templates.match("I'd like to order some pasta"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,7 +16,7 @@ from llama_index.core.schema import TextNode
 
 from opendu.core.annotation import Schema, MatchReplace, get_value
 from opendu.core.config import RauConfig
-from opendu.core.retriever import create_index, ContextRetriever
+from opendu.core.retriever import build_keyword_index, create_index, ContextRetriever
 from opendu.finetune.phase1_converter import FullExemplar, TrainPhase1Converter, YniConverter
 from opendu.finetune.phase2_converter import PromptConverter
 
@@ -57,6 +57,7 @@ def build_dataset_index(tag: str, dsc: Dataset, output: str, embedding: BaseEmbe
     build_nodes_from_dataset(tag, dsc, exemplar_nodes)
     print(f"There are {len(exemplar_nodes)} exemplars.")
     create_index(output, "exemplar", exemplar_nodes, embedding)
+    build_keyword_index(output, "exemplar", exemplar_nodes)
 
 
 class DatasetFactory(ABC):
@@ -68,7 +68,8 @@ def create_sentence_pair_for_description(
 ):
     embedding = EmbeddingStore.get_embedding_by_task("desc")
     results = []
-    for item in dataset:
+    batch_results = retriever.retrieve_batch(dataset["utterance"])
+    for item, nodesWithScore in zip(dataset, batch_results):
         utterance = item["utterance"]
         query = embedding.expand_for_query(utterance)
         label = item["owner"]
@@ -77,7 +78,6 @@ def create_sentence_pair_for_description(
         if has_no_intent(label):
             continue
 
-        nodesWithScore = retriever.retrieve(utterance)
         nodes: list[TextNode] = [item.node for item in nodesWithScore]
 
         content = embedding.expand_for_content(skills[label]["description"])
@@ -97,12 +97,12 @@ def create_sentence_pair_for_exemplars(
 ):
     embedding = EmbeddingStore.get_embedding_by_task("exemplar")
     results = []
-    for item in dataset:
+    batch_results = retriever.retrieve_batch(dataset["utterance"])
+    for item, nodesWithScore in zip(dataset, batch_results):
         utterance = item["utterance"]
         query = embedding.expand_for_query(utterance)
         label = item["owner"]
         id = item["id"]
-        nodesWithScore = retriever.retrieve(utterance)
         nodes: list[TextNode] = [item.node for item in nodesWithScore]
         pos = 0
         neg = 0
@@ -9,8 +9,8 @@ from opendu.finetune.commons import build_dataset_index, JsonDatasetFactory
 
 def compute_k(dataset: Dataset, retrieve: ContextRetriever):
     counts = [0, 0]
-    for item in dataset:
-        skills, exemplars = retrieve(item["utterance"])
+    contexts = retrieve.retrieve_batch(dataset["utterance"])
+    for item, (skills, exemplars) in zip(dataset, contexts):
         if item["owner"] == "NONE":
             continue
 
@@ -28,8 +28,8 @@ def compute_k_examplar(dataset: Dataset, retrieve: ContextRetriever):
     first_indexes = []
     first_scores = []
     BIG = 100
-    for item in dataset:
-        results = retrieve.retrieve_by_exemplar(item["utterance"])
+    batch_results = retrieve.retrieve_by_exemplar_batch(dataset["utterance"])
+    for item, results in zip(dataset, batch_results):
         if item["owner"] == "NONE":
             continue
         gindex = BIG
@@ -100,9 +100,10 @@ class MultiClassSkillConverter(TrainPhase1Converter):
 
     def __call__(self, batch, ins: list[str], outs: list[str]):
         # Working on the batched dataset, with first dimension is column then index.
+        contexts = self.context_retrieve.retrieve_batch(batch["utterance"])
         for idx, utterance in enumerate(batch["utterance"]):
             # We assume the input is dict version of AnnotatedExemplar
-            skills, nodes = self.context_retrieve(utterance)
+            skills, nodes = contexts[idx]
             # remove the identical exemplar
             nodes = [node for node in nodes if node.id_ != batch["id"][idx]]
             exemplars = [
@@ -186,9 +187,10 @@ class SingleClassSkillConverter(TrainPhase1Converter):
 
     def __call__(self, batch, ins: list[str], outs: list[str]):
         # Working on the batched dataset, with first dimension is column then index.
+        contexts = self.context_retrieve.retrieve_batch(batch["utterance"])
         for idx, utterance in enumerate(batch["utterance"]):
             # We assume the input is dict version of AnnotatedExemplar
-            skills, nodes = self.context_retrieve(utterance)
+            skills, nodes = contexts[idx]
             # remove the identical exemplar
             nodes = [node for node in nodes if node.id_ != batch["id"][idx]]
             exemplars = [
@@ -276,9 +278,10 @@ class RagSkillConverter(TrainPhase1Converter):
         assert self.mode == InstanceMode.both
 
         # Working on the batched dataset, with first dimension is column then index.
+        contexts = self.context_retrieve.retrieve_batch(batch["utterance"])
         for idx, utterance in enumerate(batch["utterance"]):
             # We assume the input is dict version of AnnotatedExemplar
-            skills, nodes = self.context_retrieve(utterance)
+            skills, nodes = contexts[idx]
 
             # remove the identical exemplar
             nodes = [node for node in nodes if node.id_ != batch["id"][idx]]
@@ -330,9 +333,10 @@ class DescExemplarConverter(TrainPhase1Converter):
 
     def __call__(self, batch, ins: list[str], outs: list[str]):
         # Working on the batched dataset, with first dimension is column then index.
+        contexts = self.context_retrieve.retrieve_batch(batch["utterance"])
         for idx, utterance in enumerate(batch["utterance"]):
             # We assume the input is dict version of AnnotatedExemplar
-            skills, nodes = self.context_retrieve(utterance)
+            skills, nodes = contexts[idx]
 
             # remove the identical exemplar
             nodes = [node for node in nodes if node.id_ != batch["id"][idx]]
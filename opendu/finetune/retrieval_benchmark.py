@@ -0,0 +1,85 @@
+import logging
+import time
+
+import numpy as np
+from opendu.core.config import RauConfig
+from opendu.core.embedding import EmbeddingStore
+from opendu.core.retriever import (MatrixVectorRetriever, build_desc_index, load_context_retrievers, load_native_index)
+from opendu.finetune.commons import build_dataset_index, JsonDatasetFactory
+from opendu.finetune.find_k_for_prompt import compute_k_examplar, find_percentile
+
+
+def load_vector_retriever(path: str, backend: str, quantization: str = "none"):
+    RauConfig.get().vector_backend = backend
+    RauConfig.get().vector_quantization = {"exemplar": quantization}
+    return MatrixVectorRetriever.load(
+        load_native_index(path), path, "exemplar", EmbeddingStore.for_exemplar(), RauConfig.get().exemplar_retrieve_topk)
+
+
+def timed(retrieve, utterances):
+    start = time.perf_counter()
+    results = retrieve(utterances)
+    return results, time.perf_counter() - start
+
+
+# The fraction of the exact top k that approximate search also returns.
+def compute_recall(exact_results, approximate_results):
+    recalls = []
+    for exact, approximate in zip(exact_results, approximate_results):
+        expected = {item.node.id_ for item in exact}
+        found = {item.node.id_ for item in approximate}
+        if len(expected) != 0:
+            recalls.append(len(expected & found) / len(expected))
+    return float(np.mean(recalls))
+
+
+#
+# This compares the hnsw backend and the quantized vectors against the exact search on the same
+# exemplar index: the recall of the vector search top k, the time for searching the utterances of
+# a split, and what compute_k_examplar finds for the hybrid retrieval with each of them.
+#
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    logger.setLevel(logging.CRITICAL)
+
+    factories = [JsonDatasetFactory("./dugsets/sgd", "sgd")]
+
+    # For now, just use the fix path.
+    output = "./output"
+
+    # Build the graph for every size, so that we can measure it.
+    RauConfig.get().vector_backend = "hnsw"
+    RauConfig.get().hnsw_min_nodes = 0
+
+    print("building index first.")
+    for factory in factories:
+        build_desc_index(factory.tag, factory.schema,
+                         f"{output}/index/{factory.tag}",
+                         EmbeddingStore.for_description())
+        build_dataset_index(factory.tag, factory["train"],
+                            f"{output}/index/{factory.tag}",
+                            EmbeddingStore.for_exemplar())
+
+    for factory in factories:
+        path = f"{output}/index/{factory.tag}"
+        utterances = factory["validation"]["utterance"]
+
+        settings = [("hnsw", "none"), ("exact", "int8"), ("exact", "binary")]
+        exact = load_vector_retriever(f"{path}/exemplar/", "exact")
+
+        # Embed once up front, so that the timing is about search only.
+        exact.retrieve_batch(utterances)
+        exact_results, exact_time = timed(exact.retrieve_batch, utterances)
+        print(f"{factory.tag} exact: {exact_time:.3f}s for {len(utterances)} utterances, {exact.resident_size()} bytes")
+        for backend, quantization in settings:
+            approximate = load_vector_retriever(f"{path}/exemplar/", backend, quantization)
+            approximate_results, approximate_time = timed(approximate.retrieve_batch, utterances)
+            recall = compute_recall(exact_results, approximate_results)
+            print(f"{factory.tag} {backend} {quantization}: recall {recall:.4f}, {approximate_time:.3f}s, {approximate.resident_size()} bytes")
+
+        for backend, quantization in [("exact", "none")] + settings:
+            RauConfig.get().vector_backend = backend
+            RauConfig.get().vector_quantization = {"exemplar": quantization}
+            searcher = load_context_retrievers(factory.schema, path)
+            first_indexes, first_scores = compute_k_examplar(factory["validation"], searcher)
+            print(f"{factory.tag} {backend} {quantization}: {find_percentile(first_indexes, 99)} {find_percentile(first_scores, 1)}")
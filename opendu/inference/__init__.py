@@ -4,3 +4,7 @@ from .index import *
 from .schema_parser import *
 from .generator import *
 from .intent_detector import *
+from .executor import *
+from .bot_cache import *
+from .index_jobs import *
+from .model_jobs import *
@@ -0,0 +1,106 @@
+# Copyright 2024, OpenCUI
+# Licensed under the Apache License, Version 2.0.
+
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+
+
+#
+# The loaded bots (parsers) are kept in least recently used order, and evicted by the total of
+# their approximate resident size, since the size of the index varies a lot from bot to bot, as
+# well as by their count. The bot just added is never evicted, even if it alone is over the budget.
+# Hits, misses and loads are kept per bot, also for bots that are evicted.
+#
+# A cold bot is loaded once: the first request loads it, the concurrent requests for the same
+# bot wait on the same future. A reindexed bot is swapped in with put, which also makes sure that
+# a load of the old index still in flight does not overwrite it.
+#
+class BotCache:
+    def __init__(self, budget: int, capacity: int):
+        self.budget = budget
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.total = 0
+        self.loading: dict[str, Future] = {}
+        self.counts = defaultdict(lambda: {"hits": 0, "misses": 0, "waits": 0, "loads": 0, "evictions": 0})
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get_or_load(self, key, load):
+        with self.lock:
+            parser = self.entries.get(key)
+            if parser is not None:
+                self.entries.move_to_end(key)
+                self.counts[key]["hits"] += 1
+                return parser
+
+            future = self.loading.get(key)
+            if future is not None:
+                self.counts[key]["waits"] += 1
+            else:
+                self.counts[key]["misses"] += 1
+                loader = self.loading[key] = Future()
+
+        if future is not None:
+            return future.result()
+
+        try:
+            parser = load()
+            size = parser.resident_size()
+        except BaseException as e:
+            with self.lock:
+                if self.loading.get(key) is loader:
+                    del self.loading[key]
+            loader.set_exception(e)
+            raise
+
+        with self.lock:
+            if self.loading.get(key) is loader:
+                del self.loading[key]
+                self.store(key, parser, size)
+        loader.set_result(parser)
+        return parser
+
+    def put(self, key, parser):
+        size = parser.resident_size()
+        with self.lock:
+            self.loading.pop(key, None)
+            self.store(key, parser, size)
+
+    # This needs to be called with the lock held.
+    def store(self, key, parser, size):
+        self.remove(key)
+        self.entries[key] = parser
+        self.sizes[key] = size
+        self.total += size
+        self.counts[key]["loads"] += 1
+        while (self.total > self.budget or len(self.entries) > self.capacity) and len(self.entries) > 1:
+            evicted, _ = self.entries.popitem(last=False)
+            self.total -= self.sizes.pop(evicted)
+            self.counts[evicted]["evictions"] += 1
+            logging.info(f"evict bot {evicted} to stay in {self.budget} bytes and {self.capacity} bots.")
+
+    # This needs to be called with the lock held.
+    def remove(self, key):
+        if key not in self.entries:
+            return None
+        self.total -= self.sizes.pop(key)
+        return self.entries.pop(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "budget": self.budget,
+                "capacity": self.capacity,
+                "size": self.total,
+                "bots": {
+                    key: {"resident": key in self.entries, "size": self.sizes.get(key, 0), **counts}
+                    for key, counts in self.counts.items()
+                }
+            }
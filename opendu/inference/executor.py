@@ -0,0 +1,57 @@
+# Copyright 2024, OpenCUI
+# Licensed under the Apache License, Version 2.0.
+
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+#
+# Embedding, retrieval and generation are all blocking, so we run them on dedicated inference
+# threads and keep the event loop for io only. The queue is bounded, so that we can shed load
+# instead of piling up requests that will time out anyway, and the task that are already past
+# their deadline when picked up are dropped without running.
+#
+class InferenceExecutor:
+    def __init__(self, workers: int, queue_size: int):
+        self.tasks = queue.Queue(maxsize=queue_size)
+        self.threads = [
+            threading.Thread(target=self.run, name=f"inference-{index}", daemon=True)
+            for index in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, deadline: float, fn, *args) -> Future:
+        future = Future()
+        try:
+            self.tasks.put_nowait((deadline, future, fn, args))
+        except queue.Full:
+            raise QueueFullError(f"inference queue is full with {self.tasks.qsize()} tasks.")
+        return future
+
+    async def call(self, timeout: float, fn, *args):
+        # Cancelling the awaiting side on timeout also cancels the task if it is still queued.
+        future = self.submit(time.monotonic() + timeout, fn, *args)
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+
+    def run(self):
+        while True:
+            deadline, future, fn, args = self.tasks.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            if time.monotonic() > deadline:
+                future.set_exception(TimeoutError("deadline passed before inference started."))
+                continue
+
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
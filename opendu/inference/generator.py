@@ -1,12 +1,21 @@
 # Copyright 2024, OpenCUI
 # Licensed under the Apache License, Version 2.0.
 
+import hashlib
+import os
+import queue
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import defaultdict
+from concurrent.futures import Future
 from enum import Enum
 
 import torch
+from lru import LRU
 from peft import PeftConfig, PeftModel
-from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig, AutoModelForSeq2SeqLM, AutoConfig
+from transformers import (AutoModelForCausalLM, AutoTokenizer, GenerationConfig, AutoModelForSeq2SeqLM, AutoConfig,
+                          LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList)
 
 from opendu import ModelType
 from opendu.core.config import RauConfig
@@ -16,6 +25,86 @@ from opendu.core.config import RauConfig
 GeneratorType = Enum("Generator", ["FftGenerator", "LoraGenerator"])
 GenerateMode = Enum("GenerateMode", ["desc", "exemplar", "extractive", "nli"])
 
+
+#
+# How we decode for a mode: at most max_new_tokens, stop at any of the stop strings, and when
+# labels is set, only allow the outputs that are one of the labels (the decision is then done as
+# soon as a label is complete). The stop strings are cut from the output.
+#
+class DecodingProfile:
+    def __init__(self, max_new_tokens: int, stops: list[str] = (), labels: list[str] = None):
+        self.max_new_tokens = max_new_tokens
+        self.stops = list(stops)
+        self.labels = labels
+
+    @staticmethod
+    def for_mode(mode: GenerateMode):
+        return decoding_profiles.get(mode, default_profile)
+
+    # One more token for the eos after the longest label.
+    def limit(self, label_tokens) -> int:
+        if label_tokens is None:
+            return self.max_new_tokens
+        return min(self.max_new_tokens, max(map(len, label_tokens)) + 1)
+
+    def finish(self, text: str) -> str:
+        for stop in self.stops:
+            text = text.split(stop, 1)[0]
+        return text.strip()
+
+
+default_profile = DecodingProfile(32)
+decoding_profiles = {
+    GenerateMode.desc: DecodingProfile(4, labels=["true", "false"]),
+    GenerateMode.exemplar: DecodingProfile(4, labels=["true", "false"]),
+    GenerateMode.extractive: DecodingProfile(32, stops=["\n"]),
+    GenerateMode.nli: DecodingProfile(8, stops=["\n"], labels=["Affirmative", "Negative", "Indifferent", "Irrelevant"]),
+}
+
+
+# This masks the logits so that each row can only continue one of its labels, and end after a
+# complete label. The rows without labels are left alone.
+class AllowedOutputs(LogitsProcessor):
+    def __init__(self, labels: list, start: int, eos_token_id: int):
+        self.labels = labels
+        self.start = start
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        for row, labels in enumerate(self.labels):
+            if labels is None:
+                continue
+            generated = input_ids[row, self.start:].tolist()
+            allowed = {
+                label[len(generated)] for label in labels
+                if len(label) > len(generated) and label[:len(generated)] == generated
+            }
+            if len(allowed) == 0 or generated in labels:
+                allowed.add(self.eos_token_id)
+            mask = torch.full_like(scores[row], float("-inf"))
+            mask[list(allowed)] = 0
+            scores[row] = scores[row] + mask
+        return scores
+
+
+# This stops the batch when every row has either ended or produced one of its stop strings.
+class StopOnStrings(StoppingCriteria):
+    def __init__(self, tokenizer, stops: list[list[str]], start: int):
+        self.tokenizer = tokenizer
+        self.stops = stops
+        self.start = start
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        for row, stops in enumerate(self.stops):
+            generated = input_ids[row, self.start:]
+            if (generated == self.tokenizer.eos_token_id).any():
+                continue
+            text = self.tokenizer.decode(generated, skip_special_tokens=True)
+            if not any(stop in text for stop in stops):
+                return False
+        return True
+
+
 # In case you are curious about decoding: https://huggingface.co/blog/how-to-generate
 # We are not interested in the variance, so we do not do sampling not beam search.
 #
@@ -31,10 +120,49 @@ class Generator(ABC):
 
     @staticmethod
     def build():
-        if GeneratorType[RauConfig.get().generator] == GeneratorType.FftGenerator and Generator.generator is None:
-            Generator.generator = FftGenerator()
-        if GeneratorType[RauConfig.get().generator] == GeneratorType.LoraGenerator and Generator.generator is None:
-            Generator.generator = LoraGenerator()
+        if Generator.generator is not None:
+            return Generator.generator
+
+        config = RauConfig.get()
+        # The parsers keep the generator they are built with, so the model is always behind a
+        # holder that reload can swap it in.
+        Generator.generator = ModelHolder(Generator.load_model())
+
+        # Generator is shared by all the bots, so we batch the prompts across the requests.
+        if config.generate_batch_window > 0:
+            Generator.generator = BatchedGenerator(
+                Generator.generator, config.generate_batch_window, config.generate_batch_size)
+
+        # The cache is in front of the batching, so that only the misses wait for a batch.
+        if config.decision_cache_size > 0:
+            Generator.generator = CachedGenerator(
+                Generator.generator, config.decision_cache_size, config.decision_cache_ttl)
+        return Generator.generator
+
+    @staticmethod
+    def load_model():
+        config = RauConfig.get()
+        if GeneratorType[config.generator] == GeneratorType.FftGenerator:
+            return FftGenerator()
+        if GeneratorType[config.generator] == GeneratorType.LoraGenerator:
+            return LoraGenerator()
+
+    # This loads the model again, for example after it is updated on disk. The loaded parsers hold
+    # on to the wrappers, so the new model is swapped in under them, and the cached decisions
+    # from the old model are dropped. The old model serves until then, so this needs memory for
+    # two copies of the model. It takes a while, so the service runs it with ModelJobs.
+    @staticmethod
+    def reload():
+        if Generator.generator is None:
+            return Generator.build()
+
+        model = Generator.load_model()
+        holder = Generator.generator
+        while not isinstance(holder, ModelHolder):
+            holder = holder.generator
+        holder.generator = model
+        if isinstance(Generator.generator, CachedGenerator):
+            Generator.generator.invalidate()
         return Generator.generator
 
     @staticmethod
@@ -56,14 +184,194 @@ class Generator(ABC):
     def generate(self, input_texts: list[str], mode: GenerateMode = None):
         pass
 
-    def process_return(self, outputs: list[str], input_texts: list[str]):
+    # For the true/false decisions, instead of decoding, we do one forward pass (one decoder step
+    # for t5) and compare the logits of the true and false token. This returns the decision and
+    # the (temperature calibrated) probability of true for each input.
+    @abstractmethod
+    def score(self, input_texts: list[str], mode: GenerateMode) -> list[tuple[bool, float]]:
+        pass
+
+    # The prompts in one batch can be for different modes. By default, we run one batch for each
+    # mode and put the results back in the order of the prompts.
+    def generate_mixed(self, input_texts: list[str], modes: list[GenerateMode]):
+        return Generator.run_by_mode(self.generate, input_texts, modes)
+
+    def score_mixed(self, input_texts: list[str], modes: list[GenerateMode]) -> list[tuple[bool, float]]:
+        return Generator.run_by_mode(self.score, input_texts, modes)
+
+    @staticmethod
+    def run_by_mode(call, input_texts: list[str], modes: list[GenerateMode]):
+        groups = defaultdict(list)
+        for index, mode in enumerate(modes):
+            groups[mode].append(index)
+
+        results = [None] * len(input_texts)
+        for mode, indexes in groups.items():
+            outputs = call([input_texts[index] for index in indexes], mode)
+            for index, output in zip(indexes, outputs):
+                results[index] = output
+        return results
+
+    @staticmethod
+    def get_bool_tokens(tokenizer):
+        return [tokenizer.encode(label, add_special_tokens=False)[0] for label in ["true", "false"]]
+
+    def next_token_logits(self, model, encoding):
         if ModelType.normalize(self.model_type) == ModelType.t5:
-            return outputs
-        if ModelType.normalize(self.model_type) == ModelType.gpt:
-            return [output[len(input_texts[index]):] for index, output in enumerate(outputs)]
+            start = torch.full(
+                (encoding.input_ids.shape[0], 1),
+                model.config.decoder_start_token_id,
+                dtype=torch.long,
+                device=encoding.input_ids.device)
+            outputs = model(
+                input_ids=encoding.input_ids,
+                attention_mask=encoding.attention_mask,
+                decoder_input_ids=start)
+        else:
+            # Inputs are left padded, so the positions need to start from the first real token.
+            position_ids = (encoding.attention_mask.cumsum(-1) - 1).clamp(min=0)
+            outputs = model(
+                input_ids=encoding.input_ids,
+                attention_mask=encoding.attention_mask,
+                position_ids=position_ids)
+        return outputs.logits[:, -1, :]
+
+    # For causal models, the prompts fanned out from one utterance share a long prefix (instruction
+    # plus utterance), so we run the common token prefix once, keep its past_key_values in a lru
+    # cache keyed by the prefix tokens, and only run the unique suffixes. The prompts are laid out
+    # as prefix, padding, suffix so that the prefix sits at the same positions for all of them.
+    # This returns None when prefix caching does not apply.
+    def encode_with_prefix(self, model, input_texts: list[str], adapter: str = None):
+        if self.prefix_cache is None or ModelType.normalize(self.model_type) != ModelType.gpt:
+            return None
+
+        token_lists = self.tokenizer(input_texts, truncation=True)["input_ids"]
+        # Keep at least one token in each suffix, as we need its logits.
+        length = min(len(os.path.commonprefix(token_lists)), min(map(len, token_lists)) - 1)
+        if length < RauConfig.get().prefix_cache_min_length:
+            return None
+
+        device = RauConfig.get().llm_device
+        prefix = token_lists[0][:length]
+        key = (adapter, tuple(prefix))
+        past = self.prefix_cache.get(key)
+        if past is None:
+            with torch.no_grad():
+                outputs = model(input_ids=torch.tensor([prefix], device=device), use_cache=True)
+            past = outputs.past_key_values
+            if hasattr(past, "to_legacy_cache"):
+                past = past.to_legacy_cache()
+            self.prefix_cache.put(key, past)
+
+        suffixes = [tokens[length:] for tokens in token_lists]
+        width = max(map(len, suffixes))
+        pad = self.tokenizer.pad_token_id
+        input_ids = [prefix + [pad] * (width - len(suffix)) + suffix for suffix in suffixes]
+        attention_mask = [[1] * length + [0] * (width - len(suffix)) + [1] * len(suffix) for suffix in suffixes]
+        batch = len(input_texts)
+        past = tuple(tuple(tensor.expand(batch, *tensor.shape[1:]) for tensor in layer) for layer in past)
+        return (
+            torch.tensor(input_ids, device=device),
+            torch.tensor(attention_mask, device=device),
+            past,
+            length)
+
+    # This decodes the prompts greedily, each with the profile of its mode: the labels it allows,
+    # when it stops, and how many tokens it can take.
+    def decode(self, model, input_texts: list[str], modes: list[GenerateMode], adapter: str = None) -> list[str]:
+        prefixed = self.encode_with_prefix(model, input_texts, adapter)
+        kwargs = {}
+        if prefixed is not None:
+            input_ids, attention_mask, kwargs["past_key_values"], _ = prefixed
+        else:
+            encoding = self.tokenizer(
+                input_texts, padding=True, truncation=True, return_tensors="pt"
+            ).to(RauConfig.get().llm_device)
+            input_ids, attention_mask = encoding.input_ids, encoding.attention_mask
+
+        # For t5, the outputs are the decoder tokens after the start token, for causal models
+        # they follow the prompt.
+        start = input_ids.shape[1] if ModelType.normalize(self.model_type) == ModelType.gpt else 1
+        profiles = [DecodingProfile.for_mode(mode) for mode in modes]
+        constrained = RauConfig.get().constrained_decoding
+        labels = [self.get_label_tokens(profile) if constrained else None for profile in profiles]
+        limits = [profile.limit(tokens) for profile, tokens in zip(profiles, labels)]
+
+        if any(tokens is not None for tokens in labels):
+            kwargs["logits_processor"] = LogitsProcessorList([
+                AllowedOutputs(labels, start, self.tokenizer.eos_token_id)])
+        if any(len(profile.stops) != 0 for profile in profiles):
+            kwargs["stopping_criteria"] = StoppingCriteriaList([
+                StopOnStrings(self.tokenizer, [profile.stops for profile in profiles], start)])
+
+        with torch.no_grad():
+            outputs = model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                generation_config=GenerationConfig(
+                    max_new_tokens=max(limits),
+                    pad_token_id=self.tokenizer.eos_token_id,
+                    bos_token_id=self.tokenizer.bos_token_id,
+                    eos_token_id=self.tokenizer.eos_token_id,
+                    do_sample=False,
+                    repetition_penalty=1.2,
+                    num_return_sequences=1,
+                ),
+                **kwargs
+            )
+        texts = self.tokenizer.batch_decode(
+            [outputs[row, start:start + limit] for row, limit in enumerate(limits)], skip_special_tokens=True)
+        return [profile.finish(text) for profile, text in zip(profiles, texts)]
+
+    # The token ids of each allowed label, None when the profile allows any output.
+    def get_label_tokens(self, profile):
+        if profile.labels is None:
+            return None
+        if profile not in self.label_tokens:
+            self.label_tokens[profile] = [
+                self.tokenizer.encode(label, add_special_tokens=False) for label in profile.labels]
+        return self.label_tokens[profile]
+
+    @staticmethod
+    def next_token_logits_with_prefix(model, prefixed):
+        input_ids, attention_mask, past, length = prefixed
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        outputs = model(
+            input_ids=input_ids[:, length:],
+            attention_mask=attention_mask,
+            position_ids=position_ids[:, length:],
+            past_key_values=past)
+        return outputs.logits[:, -1, :]
+
+    def score_by_logits(self, logits) -> list[tuple[bool, float]]:
+        pair = logits[:, self.bool_tokens].float() / RauConfig.get().score_temperature
+        probs = torch.softmax(pair, dim=-1)[:, 0].tolist()
+        return [(prob >= 0.5, prob) for prob in probs]
+
+
+# The past_key_values of the shared prompt prefixes, this is used by multiple threads.
+class PrefixCache:
+    def __init__(self, size: int):
+        self.entries = LRU(size)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def build():
+        size = RauConfig.get().prefix_cache_size
+        return PrefixCache(size) if size > 0 else None
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key, past):
+        with self.lock:
+            self.entries[key] = past
 
 
 # This should be desc/exemplar based.
+# The peft version we use can only have one active adapter for a forward pass, so the prompts of
+# a mixed batch still run one adapter at a time.
 class LoraGenerator(Generator, ABC):
     def __init__(self):
         parts = RauConfig.get().skill_model.split("/")
@@ -86,10 +394,18 @@ class LoraGenerator(Generator, ABC):
             torch_dtype=torch.bfloat16
         )
 
+        self.model_type = Generator.get_model_type(model_path)
         self.tokenizer = AutoTokenizer.from_pretrained(model_path)
         self.tokenizer.pad_token = self.tokenizer.eos_token
         self.tokenizer.padding_side = "left"
+        self.bool_tokens = Generator.get_bool_tokens(self.tokenizer)
+        self.prefix_cache = PrefixCache.build()
+        self.label_tokens = {}
         self.models = {}
+        # Without the batching, the inference threads call in directly, and the active adapter
+        # is the state of the model, so the calls are serialized.
+        self.lock = threading.Lock()
+        self.model_id = RauConfig.get().skill_model
 
         self.lora_model = PeftModel.from_pretrained(
             base_model, desc_model, adapter_name=GenerateMode.desc.name)
@@ -108,27 +424,28 @@ class LoraGenerator(Generator, ABC):
         self.lora_model.eval()
 
     def generate(self, input_texts: list[str], mode: GenerateMode):
-        self.lora_model.set_adapter(mode.name)
-        encoding = self.tokenizer(
-            input_texts, padding=True, return_tensors="pt"
-        ).to(RauConfig.get().llm_device)
+        if len(input_texts) == 0:
+            return []
 
-        with torch.no_grad():
-            peft_outputs = self.lora_model.generate(
-                input_ids=encoding.input_ids,
-                generation_config=GenerationConfig(
-                    max_new_tokens=32,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                    attention_mask=encoding.attention_mask,
-                    do_sample=False,
-                    repetition_penalty=1.2,
-                    num_return_sequences=1,
-                ),
-            )
+        with self.lock:
+            self.lora_model.set_adapter(mode.name)
+            return self.decode(self.lora_model, input_texts, [mode] * len(input_texts), mode.name)
+
+    def score(self, input_texts: list[str], mode: GenerateMode) -> list[tuple[bool, float]]:
+        if len(input_texts) == 0:
+            return []
 
-        results = self.tokenizer.batch_decode(peft_outputs, skip_special_tokens=True)
-        return Generator.process_return(results, input_texts)
+        with self.lock, torch.no_grad():
+            self.lora_model.set_adapter(mode.name)
+            prefixed = self.encode_with_prefix(self.lora_model, input_texts, mode.name)
+            if prefixed is not None:
+                logits = self.next_token_logits_with_prefix(self.lora_model, prefixed)
+            else:
+                encoding = self.tokenizer(
+                    input_texts, padding=True, truncation=True, return_tensors="pt"
+                ).to(RauConfig.get().llm_device)
+                logits = self.next_token_logits(self.lora_model, encoding)
+        return self.score_by_logits(logits)
 
 
 # Full finetuned generator
@@ -144,38 +461,247 @@ class FftGenerator(Generator, ABC):
             torch_dtype=torch.bfloat16
         )
         self.model_type = Generator.get_model_type(RauConfig.get().model)
+        self.model_id = RauConfig.get().model
         self.model.eval()
         self.tokenizer = AutoTokenizer.from_pretrained(RauConfig.get().model)
         self.tokenizer.pad_token = self.tokenizer.eos_token
         self.tokenizer.padding_side = "left"
+        self.bool_tokens = Generator.get_bool_tokens(self.tokenizer)
+        self.prefix_cache = PrefixCache.build()
+        self.label_tokens = {}
+        # Without the batching, the inference threads call in directly, one batch at a time.
+        self.lock = threading.Lock()
 
         # Move to device
         self.model.to(RauConfig.get().llm_device)
         self.model.eval()
 
     def generate(self, input_texts: list[str], mode: GenerateMode):
+        return self.generate_mixed(input_texts, [mode] * len(input_texts))
+
+    # All the modes use the same model, so the prompts of a mixed batch run together.
+    def generate_mixed(self, input_texts: list[str], modes: list[GenerateMode]):
         # The tokenizer can not handle empty list, so we safeguard that.
         if len(input_texts) == 0:
             return []
+        with self.lock:
+            return self.decode(self.model, input_texts, modes)
 
-        encoding = self.tokenizer(
-            input_texts, padding=True, truncation=True, return_tensors="pt"
-        ).to(RauConfig.get().llm_device)
+    def score_mixed(self, input_texts: list[str], modes: list[GenerateMode]) -> list[tuple[bool, float]]:
+        return self.score(input_texts, None)
 
-        with torch.no_grad():
-            outputs = self.model.generate(
-                input_ids=encoding.input_ids,
-                generation_config=GenerationConfig(
-                    max_new_tokens=32,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    bos_token_id=self.tokenizer.bos_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                    attention_mask=encoding.attention_mask,
-                    do_sample=False,
-                    repetition_penalty=1.2,
-                    num_return_sequences=1,
-                ),
-            )
-        results = self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
-        return self.process_return(results, input_texts)
+    def score(self, input_texts: list[str], mode: GenerateMode) -> list[tuple[bool, float]]:
+        if len(input_texts) == 0:
+            return []
+
+        with self.lock, torch.no_grad():
+            prefixed = self.encode_with_prefix(self.model, input_texts)
+            if prefixed is not None:
+                logits = self.next_token_logits_with_prefix(self.model, prefixed)
+            else:
+                encoding = self.tokenizer(
+                    input_texts, padding=True, truncation=True, return_tensors="pt"
+                ).to(RauConfig.get().llm_device)
+                logits = self.next_token_logits(self.model, encoding)
+        return self.score_by_logits(logits)
+
+
+# The model that all the wrappers and parsers share, reload swaps a new one in here.
+class ModelHolder(Generator):
+    def __init__(self, generator: Generator):
+        self.generator = generator
+
+    @property
+    def model_id(self):
+        return self.generator.model_id
+
+    def generate(self, input_texts: list[str], mode: GenerateMode):
+        return self.generator.generate(input_texts, mode)
+
+    def score(self, input_texts: list[str], mode: GenerateMode) -> list[tuple[bool, float]]:
+        return self.generator.score(input_texts, mode)
+
+    def generate_mixed(self, input_texts: list[str], modes: list[GenerateMode]):
+        return self.generator.generate_mixed(input_texts, modes)
+
+    def score_mixed(self, input_texts: list[str], modes: list[GenerateMode]) -> list[tuple[bool, float]]:
+        return self.generator.score_mixed(input_texts, modes)
+
+
+#
+# This collects the prompts from concurrent requests, for up to window seconds or until we have
+# max_size prompts, and runs them through the wrapped generator in one mixed batch per call kind
+# (generate or score), the wrapped generator decides whether the modes can share a forward pass.
+# The results are then fanned back out to the waiting callers. Prompts from one call are never
+# split across batches.
+#
+class BatchedGenerator(Generator):
+    def __init__(self, generator: Generator, window: float, max_size: int):
+        self.generator = generator
+        self.window = window
+        self.max_size = max_size
+        self.pending = queue.Queue()
+        # The request that did not fit into last batch, it starts the next one.
+        self.carry = None
+        self.worker = threading.Thread(target=self.run, name="batched-generator", daemon=True)
+        self.worker.start()
+
+    @property
+    def model_id(self):
+        return self.generator.model_id
+
+    def generate(self, input_texts: list[str], mode: GenerateMode):
+        return self.submit("generate", input_texts, [mode] * len(input_texts))
+
+    def score(self, input_texts: list[str], mode: GenerateMode) -> list[tuple[bool, float]]:
+        return self.submit("score", input_texts, [mode] * len(input_texts))
+
+    def generate_mixed(self, input_texts: list[str], modes: list[GenerateMode]):
+        return self.submit("generate", input_texts, modes)
+
+    def score_mixed(self, input_texts: list[str], modes: list[GenerateMode]) -> list[tuple[bool, float]]:
+        return self.submit("score", input_texts, modes)
+
+    def submit(self, kind: str, input_texts: list[str], modes: list[GenerateMode]):
+        if len(input_texts) == 0:
+            return []
+        future = Future()
+        self.pending.put((input_texts, kind, modes, future))
+        return future.result()
+
+    def collect(self):
+        if self.carry is not None:
+            batch, self.carry = [self.carry], None
+        else:
+            batch = [self.pending.get()]
+
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.window
+        while size < self.max_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.pending.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if size + len(item[0]) > self.max_size:
+                self.carry = item
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def dispatch(self, kind, items):
+        input_texts = [text for texts, _, _, _ in items for text in texts]
+        modes = [mode for _, _, modes, _ in items for mode in modes]
+        try:
+            outputs = getattr(self.generator, f"{kind}_mixed")(input_texts, modes)
+        except Exception as e:
+            for _, _, _, future in items:
+                future.set_exception(e)
+            return
+
+        start = 0
+        for texts, _, _, future in items:
+            future.set_result(outputs[start:start + len(texts)])
+            start += len(texts)
+
+    def run(self):
+        while True:
+            groups = defaultdict(list)
+            for item in self.collect():
+                groups[item[1]].append(item)
+            for kind, items in groups.items():
+                self.dispatch(kind, items)
+
+
+#
+# The decisions only depend on the prompt (we decode greedily), and the same utterance and template
+# pairs recur in the traffic, so we keep the outputs in a bounded lru cache keyed by the model,
+# the call kind, the mode and the hash of the prompt. The entries expire after ttl seconds, and
+# the cache is dropped when the model is reloaded. Only the misses of a batch go to the model.
+#
+class CachedGenerator(Generator):
+    def __init__(self, generator: Generator, size: int, ttl: float):
+        self.generator = generator
+        self.size = size
+        self.ttl = ttl
+        self.entries = LRU(size)
+        self.lock = threading.Lock()
+        # This changes on invalidate, so the outputs of a call that started before are not kept.
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def model_id(self):
+        return self.generator.model_id
+
+    def generate(self, input_texts: list[str], mode: GenerateMode):
+        return self.lookup("generate", input_texts, [mode] * len(input_texts))
+
+    def score(self, input_texts: list[str], mode: GenerateMode) -> list[tuple[bool, float]]:
+        return self.lookup("score", input_texts, [mode] * len(input_texts))
+
+    def generate_mixed(self, input_texts: list[str], modes: list[GenerateMode]):
+        return self.lookup("generate", input_texts, modes)
+
+    def score_mixed(self, input_texts: list[str], modes: list[GenerateMode]) -> list[tuple[bool, float]]:
+        return self.lookup("score", input_texts, modes)
+
+    def lookup(self, kind: str, input_texts: list[str], modes: list[GenerateMode]):
+        if len(input_texts) == 0:
+            return []
 
+        model_id = self.model_id
+        keys = [
+            (model_id, kind, mode, hashlib.sha1(text.encode("utf-8")).hexdigest())
+            for text, mode in zip(input_texts, modes)
+        ]
+        now = time.monotonic()
+        results = [None] * len(keys)
+        missing = []
+        with self.lock:
+            version = self.version
+            for index, key in enumerate(keys):
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] > now:
+                    results[index] = entry[1]
+                else:
+                    missing.append(index)
+
+        # The same prompt can show up more than once in a batch, we only run it once.
+        unique = {}
+        for index in missing:
+            unique.setdefault(keys[index], index)
+        outputs = {}
+        if len(unique) != 0:
+            indexes = list(unique.values())
+            values = getattr(self.generator, f"{kind}_mixed")(
+                [input_texts[index] for index in indexes], [modes[index] for index in indexes])
+            outputs = dict(zip(unique.keys(), values))
+            for index in missing:
+                results[index] = outputs[keys[index]]
+
+        with self.lock:
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+            if version == self.version:
+                for key, value in outputs.items():
+                    self.entries[key] = (now + self.ttl, value)
+        return results
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.version += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "capacity": self.size,
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses
+            }
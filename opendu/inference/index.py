@@ -10,7 +10,8 @@ import traceback
 
 from opendu.core.annotation import (Exemplar, FrameSchema, build_nodes_from_exemplar_store)
 from opendu.core.embedding import EmbeddingStore
-from opendu.core.retriever import (build_nodes_from_skills, create_index)
+from opendu.core.retriever import (build_keyword_index, build_nodes_from_skills, create_index, remove_index)
+from opendu.core.template_index import TemplateIndex
 from opendu.inference.schema_parser import load_all_from_directory
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
@@ -46,10 +47,20 @@ def indexing(module):
         print(f"create exemplar index for {module}")
         create_index(output_path, "exemplar", exemplar_nodes,
                      EmbeddingStore.for_exemplar())
+        build_keyword_index(output_path, "exemplar", exemplar_nodes)
+    else:
+        remove_index(output_path, "exemplar")
+
     if len(desc_nodes) != 0:
         print(f"create desc index for {module}")
         create_index(output_path, "desc", desc_nodes,
                      EmbeddingStore.for_description())
+    else:
+        remove_index(output_path, "desc")
+
+    templates = TemplateIndex.build(examplers, recognizers)
+    print(f"create template index for {module} with {len(templates)} templates")
+    templates.save(output_path)
 
     print(f"index for {module} is done")
 
@@ -0,0 +1,75 @@
+# Copyright 2024, OpenCUI
+# Licensed under the Apache License, Version 2.0.
+
+import logging
+import multiprocessing
+import threading
+import time
+import traceback as tb
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from opendu.inference.index import indexing
+
+
+#
+# Indexing embeds all the descriptions and exemplars of a bot, so it runs as a background job in
+# a process pool instead of in the request handler. When indexing is done, the new index is loaded
+# on a loader thread and handed to on_done, while the old index keeps serving. There is at most one
+# running job per bot, since the jobs for the same bot write the same files.
+# The pool uses spawn, the worker processes load their own embedding models.
+#
+class IndexJobs:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.pool = self.new_pool()
+        self.loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="index-loader")
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    # This returns the job and whether it is just started, or the job that is still running.
+    def submit(self, bot: str, bot_path: str, on_done):
+        with self.lock:
+            job = self.jobs.get(bot)
+            if job is not None and job["status"] in {"indexing", "loading"}:
+                return dict(job), False
+
+            try:
+                future = self.pool.submit(indexing, bot_path)
+            except BrokenProcessPool:
+                # A worker died, for example out of memory, so we start over with a new pool.
+                self.pool = self.new_pool()
+                future = self.pool.submit(indexing, bot_path)
+
+            job = {"id": uuid.uuid4().hex, "bot": bot, "status": "indexing", "submitted": time.time()}
+            self.jobs[bot] = job
+
+        future.add_done_callback(lambda result: self.loader.submit(self.finish, job, result, on_done))
+        return dict(job), True
+
+    def finish(self, job, result, on_done):
+        try:
+            result.result()
+            self.update(job, status="loading")
+            on_done()
+            self.update(job, status="done")
+        except Exception as e:
+            logging.error(f"index job {job['id']} for {job['bot']} failed: {e}")
+            self.update(job, status="failed", error=''.join(tb.format_exception(None, e, e.__traceback__)))
+
+    def update(self, job, **fields):
+        with self.lock:
+            job.update(fields, updated=time.time())
+
+    def status(self, bot: str):
+        with self.lock:
+            job = self.jobs.get(bot)
+            return None if job is None else dict(job)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.loader.shutdown(wait=False, cancel_futures=True)
@@ -2,8 +2,9 @@
 # Licensed under the Apache License, Version 2.0.
 
 import json
+import threading
 from abc import ABC, abstractmethod
-from collections import defaultdict
+from collections import Counter, defaultdict
 
 from opendu.core.annotation import (CamelToSnake, DialogExpectation, Exemplar, OwnerMode, ExactMatcher)
 from opendu.core.config import RauConfig
@@ -29,20 +30,24 @@ class IntentDetector(ABC):
 
 
 # This is used to pick the owner by first accumulate on the exemplars by weight 2
-# then accumulate on desc by weight 1.
+# then accumulate on desc by weight 1. The owner is decided by the votes, when the
+# decisions come with probabilities, the votes weighted by them break the ties and
+# give the margin for the cascade.
 class SingleOwnerKnnPicker:
     def __init__(self, expected):
         self.counts = defaultdict(int)
+        self.scores = defaultdict(float)
         # This we make sure that
         self.modes = [OwnerMode.normal]
         self.expectedTypes = SingleOwnerKnnPicker.get_types(expected)
         self.weightForExpected = 0.0
         
-    def accumulate(self, flags: list[bool], owners: list[str], weight=2):
+    def accumulate(self, flags: list[bool], owners: list[str], weight=2, probs: list[float] = None):
         assert len(flags) == len(owners)
         for index, flag in enumerate(flags):
             if flag:
                 self.counts[owners[index]] += weight
+                self.scores[owners[index]] += weight if probs is None else weight * probs[index]
 
     @staticmethod
     def get_types(expected: list[DialogExpectation]):
@@ -59,12 +64,52 @@ class SingleOwnerKnnPicker:
             if pair[0] in self.expectedTypes:
                 pair[1] += self.weightForExpected
 
+    # The owners by votes, then by the weighted votes.
+    def ranked(self):
+        return sorted(self.counts.keys(), key=lambda owner: (-self.counts[owner], -self.scores[owner]))
+
+    # The leading owner is confident when its votes pass the threshold (and what decide needs),
+    # and its weighted votes lead the runner up by at least the margin.
+    def confident(self, threshold: float, margin: float) -> bool:
+        owners = self.ranked()
+        if len(owners) == 0:
+            return False
+        runner_up = max((self.scores[owner] for owner in owners[1:]), default=0.0)
+        return self.counts[owners[0]] > max(threshold, 1) and self.scores[owners[0]] - runner_up >= margin
+
+    # Each prompt gives its owner at most one vote, so a stage can only make the picker confident
+    # when it has more prompts than the threshold for some owner.
+    @staticmethod
+    def can_be_confident(owners, threshold: float) -> bool:
+        counts = Counter(owners)
+        return len(counts) != 0 and max(counts.values()) > max(threshold, 1)
+
     def decide(self):
-        pairs = list(self.counts.items())
-        pairs.sort(key=lambda x: -x[1])
+        owners = list(filter(lambda owner: self.counts[owner] > 1, self.ranked()))
+        return None if len(owners) == 0 else owners[0]
+
+
+# For the cascade, this counts for each stage how often it runs first, and how often the picker
+# is confident after it so that the other stage is skipped.
+class CascadeStats:
+    def __init__(self):
+        self.counts = defaultdict(lambda: {"first": 0, "exits": 0})
+        self.lock = threading.Lock()
+
+    def record(self, stage: str, exited: bool):
+        with self.lock:
+            self.counts[stage]["first"] += 1
+            self.counts[stage]["exits"] += 1 if exited else 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                stage: {**counts, "exit_rate": counts["exits"] / counts["first"]}
+                for stage, counts in self.counts.items()
+            }
 
-        pairs = list(filter(lambda x: x[1] > 1, pairs))
-        return None if len(pairs) == 0 else pairs[0][0]
+
+cascade_stats = CascadeStats()
 
 
 # This use nearest neighbors in the exemplar space, and some simple voting for determine the skills.
@@ -114,6 +159,24 @@ class KnnIntentDetector(IntentDetector, ABC):
             owners.append(skill["name"])
         return skill_prompts, owners
 
+    # This sends the prompts, which can be for different modes, to the generator as one batch, and
+    # returns the decisions, their probabilities and the raw outputs. With skill scoring, the
+    # probabilities also stand in for the raw outputs. When decoding, the probabilities are None,
+    # and the unparsable output is kept as the decision for exemplar prompts.
+    def judge(self, prompts, modes: list[GenerateMode]):
+        if RauConfig.get().skill_scoring:
+            scores = self.generator.score_mixed(prompts, modes)
+            preds = [flag for flag, _ in scores]
+            probs = [prob for _, prob in scores]
+            return preds, probs, probs
+
+        outputs = self.generator.generate_mixed(prompts, modes)
+        preds = [
+            parse_json_from_string(raw_flag, raw_flag if modes[index] == GenerateMode.exemplar else None)
+            for index, raw_flag in enumerate(outputs)
+        ]
+        return preds, None, outputs
+
     @staticmethod
     def parse_results(skill_prompts, owners, skill_outputs, owner_modes):
         if RauConfig.get().converter_debug:
@@ -128,7 +191,7 @@ class KnnIntentDetector(IntentDetector, ABC):
 
 
     @staticmethod
-    def accumulate_debug_for_exemplars(preds, nodes, infos):
+    def accumulate_debug_for_exemplars(preds, nodes, infos, probs=None):
         assert len(preds) == len(nodes)
         for index in range(len(preds)):
             item = {
@@ -137,10 +200,12 @@ class KnnIntentDetector(IntentDetector, ABC):
                 "text": nodes[index].text,
                 "result": preds[index]
             }
+            if probs is not None:
+                item["prob"] = probs[index]
             infos.append(item)
 
     @staticmethod
-    def accumulate_debug_for_skills(preds, skills, infos):
+    def accumulate_debug_for_skills(preds, skills, infos, probs=None):
         assert len(preds) == len(skills)
         for index in range(len(preds)):
             item = {
@@ -149,8 +214,32 @@ class KnnIntentDetector(IntentDetector, ABC):
                 "text": skills[index].description,
                 "result": preds[index]
             }
+            if probs is not None:
+                item["prob"] = probs[index]
             infos.append(item)
 
+    # This runs the prompts of the stages in one batch, and adds their votes to the picker.
+    def vote(self, picker, stages, debug_infos=None):
+        prompts = [prompt for stage in stages for prompt in stage[1]]
+        modes = [stage[3] for stage in stages for _ in stage[1]]
+        all_preds, all_probs, _ = self.judge(prompts, modes)
+        print(prompts)
+        print(all_preds)
+
+        start = 0
+        for _, stage_prompts, owners, mode, items in stages:
+            end = start + len(stage_prompts)
+            preds = all_preds[start:end]
+            probs = None if all_probs is None else all_probs[start:end]
+            if debug_infos is not None:
+                if mode == GenerateMode.exemplar:
+                    self.accumulate_debug_for_exemplars(preds, items, debug_infos, probs)
+                else:
+                    self.accumulate_debug_for_skills(preds, items, debug_infos, probs)
+
+            picker.accumulate(preds, owners, 1, probs)
+            start = end
+
     def detect_intents(self, text, expectations, debug=False):
         print(f"parse for skill: {text} with {expectations}")
         # For now, we only pick one skill
@@ -158,45 +247,40 @@ class KnnIntentDetector(IntentDetector, ABC):
         skills, exemplar_nodes = self.retrieve(text)
         print(f"get_skills for {text} with {len(exemplar_nodes)} nodes\n")
 
-        debug_infos = []
-
-        # for exemplar
-        if self.use_exemplar:
-            exemplar_prompts, owners, owner_modes = self.build_prompts_by_examples(text, exemplar_nodes)
-            exemplar_outputs = self.generator.generate(exemplar_prompts, GenerateMode.exemplar)
-
-            exemplar_preds = [
-                parse_json_from_string(raw_flag, raw_flag)
-                for index, raw_flag in enumerate(exemplar_outputs)
-            ]
-            print(exemplar_prompts)
-            print(exemplar_preds)
-            if debug:
-                self.accumulate_debug_for_exemplars(exemplar_preds, exemplar_nodes, debug_infos)
-
-            picker.accumulate(exemplar_preds, owners, 1)
+        debug_infos = [] if debug else None
 
         # Now we should use the expectation for improve node score, and filtering
         # the contextual template that is not match.
+        stages = []
+        if self.use_exemplar:
+            exemplar_prompts, owners, owner_modes = self.build_prompts_by_examples(text, exemplar_nodes)
+            stages.append(("exemplar", exemplar_prompts, owners, GenerateMode.exemplar, exemplar_nodes))
 
-        # for desc
         if self.use_desc:
             desc_prompts, owners = self.build_prompts_by_desc(text, skills)
+            stages.append(("desc", desc_prompts, owners, GenerateMode.desc, skills))
 
-            desc_outputs = self.generator.generate(desc_prompts, GenerateMode.desc)
-            desc_preds = [
-                parse_json_from_string(raw_flag, None)
-                for index, raw_flag in enumerate(desc_outputs)
-            ]
-            print(desc_prompts)
-            print(desc_preds)
-            if debug:
-                self.accumulate_debug_for_skills(desc_preds, skills, debug_infos)
-
-            picker.accumulate(desc_preds, owners, 1)
+        config = RauConfig.get()
+        conclusive = [
+            stage for stage in stages
+            if SingleOwnerKnnPicker.can_be_confident(stage[2], config.cascade_threshold)
+        ]
+        if config.skill_cascade and len(stages) == 2 and len(conclusive) != 0:
+            # Of the stages that can end the cascade, the one with fewer prompts runs first, and
+            # the other only when the picker is not sure. Desc has one prompt per skill, so it
+            # never ends the cascade. When no stage can, both run as one batch.
+            first = min(conclusive, key=lambda stage: len(stage[1]))
+            second = stages[1] if first is stages[0] else stages[0]
+            self.vote(picker, [first], debug_infos)
+            exited = picker.confident(config.cascade_threshold, config.cascade_margin)
+            cascade_stats.record(first[0], exited)
+            if not exited:
+                self.vote(picker, [second], debug_infos)
+        else:
+            self.vote(picker, stages, debug_infos)
 
         label = picker.decide()
-        return label, list(map(node_to_exemplar, exemplar_nodes)), debug_infos
+        return label, list(map(node_to_exemplar, exemplar_nodes)), [] if debug_infos is None else debug_infos
 
 
     @staticmethod
@@ -229,29 +313,22 @@ class KnnIntentDetector(IntentDetector, ABC):
 
         # for exemplar
         exemplar_prompts, owners, owner_modes = self.build_prompts_by_examples(text, nodes, CamelToSnake)
-        exemplar_outputs = self.generator.generate(exemplar_prompts, GenerateMode.exemplar)
-        exemplar_preds = [
-            parse_json_from_string(raw_flag, raw_flag)
-            for index, raw_flag in enumerate(exemplar_outputs)
-        ]
+        exemplar_preds, exemplar_probs, exemplar_outputs = self.judge(
+            exemplar_prompts, [GenerateMode.exemplar] * len(exemplar_prompts))
         exemplar_truth = [
             self.matcher.agree(owner, owner_mode, lowner, owner_modes[index])
             for index, lowner in enumerate(owners)]
 
         assert len(exemplar_preds) == len(exemplar_truth)
-        picker.accumulate(exemplar_preds, owners, 2)
+        picker.accumulate(exemplar_preds, owners, 2, exemplar_probs)
 
         # for desc
         desc_prompts, owners = self.build_prompts_by_desc(text, skills, CamelToSnake)
-        desc_outputs = self.generator.generate(desc_prompts, GenerateMode.desc)
-        desc_preds = [
-            parse_json_from_string(raw_flag, None)
-            for index, raw_flag in enumerate(desc_outputs)
-        ]
+        desc_preds, desc_probs, desc_outputs = self.judge(desc_prompts, [GenerateMode.desc] * len(desc_prompts))
         desc_truth = [owner == lowner and OwnerMode[owner_mode] == OwnerMode.normal for lowner in owners]
         assert len(desc_preds) == len(desc_truth)
 
-        picker.accumulate(desc_preds, owners, 1)
+        picker.accumulate(desc_preds, owners, 1, desc_probs)
         counts = count_dict["skill"]
         predicted_owner = picker.decide()
         concrete = count_dict["skills"]
@@ -274,7 +351,10 @@ class KnnIntentDetector(IntentDetector, ABC):
 
 
 def node_to_exemplar(node):
-    meta = node.metadata
+    return meta_to_exemplar(node.metadata)
+
+
+def meta_to_exemplar(meta):
     result = {
         "type": "exemplar",
         "template": meta["template"],
@@ -0,0 +1,54 @@
+# Copyright 2024, OpenCUI
+# Licensed under the Apache License, Version 2.0.
+
+import logging
+import threading
+import time
+import traceback as tb
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from opendu.inference.generator import Generator
+
+
+#
+# Loading the model takes longer than a request should wait, so reloading it runs as a background
+# job on a loader thread, and the client polls the status. The old model keeps serving until the
+# new one is swapped in, so at the peak, two copies of the model are in (gpu) memory. There is at
+# most one reload running.
+#
+class ModelJobs:
+    def __init__(self):
+        self.loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-loader")
+        self.job = None
+        self.lock = threading.Lock()
+
+    # This returns the job and whether it is just started, or the job that is still running.
+    def submit(self):
+        with self.lock:
+            if self.job is not None and self.job["status"] == "loading":
+                return dict(self.job), False
+            job = {"id": uuid.uuid4().hex, "status": "loading", "submitted": time.time()}
+            self.job = job
+
+        self.loader.submit(self.reload, job)
+        return dict(job), True
+
+    def reload(self, job):
+        try:
+            Generator.reload()
+            self.update(job, status="done")
+        except Exception as e:
+            logging.error(f"model reload {job['id']} failed: {e}")
+            self.update(job, status="failed", error=''.join(tb.format_exception(None, e, e.__traceback__)))
+
+    def update(self, job, **fields):
+        with self.lock:
+            job.update(fields, updated=time.time())
+
+    def status(self):
+        with self.lock:
+            return None if self.job is None else dict(self.job)
+
+    def shutdown(self):
+        self.loader.shutdown(wait=False, cancel_futures=True)
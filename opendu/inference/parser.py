@@ -5,11 +5,12 @@ import json
 import re
 from enum import Enum
 
-from opendu.inference.intent_detector import KnnIntentDetector
+from opendu.inference.intent_detector import KnnIntentDetector, meta_to_exemplar
 from opendu.core.annotation import (EntityMetas, FrameValue, ListRecognizer, get_value)
 from opendu.core.config import RauConfig
 from opendu.core.prompt import (promptManager0, Task)
 from opendu.core.retriever import (ContextRetriever, load_context_retrievers)
+from opendu.core.template_index import TemplateIndex
 from opendu.inference.schema_parser import load_all_from_directory
 from opendu.inference.generator import GenerateMode, Generator
 
@@ -31,8 +32,10 @@ class Parser:
             retriever: ContextRetriever,
             entity_metas: EntityMetas = None,
             with_arguments=True,
+            templates: TemplateIndex = None,
     ):
         self.retrieve = retriever
+        self.templates = templates
         self.recognizer = None
         if entity_metas is not None:
             self.recognizer = ListRecognizer(entity_metas)
@@ -46,6 +49,9 @@ class Parser:
         self.skill_converter = KnnIntentDetector(retriever, self.generator)
         self.yni_results = {"Affirmative", "Negative", "Indifferent", "Irrelevant" }
 
+    # The generator and embedding models are shared by all the bots, so only the index counts.
+    def resident_size(self) -> int:
+        return self.retrieve.resident_size()
 
     # Reference implementation for function calling.
     def understand(self, text: str) -> FrameValue:
@@ -98,6 +104,11 @@ class Parser:
 
 
     def detect_triggerables(self, utterance, expectations, debug=False):
+        if self.templates is not None and RauConfig.get().template_fast_path:
+            meta = self.templates.match(utterance)
+            if meta is not None:
+                return [{"owner": meta["owner"], "utterance": utterance, "evidence": [meta_to_exemplar(meta)]}]
+
         func_name, evidence, _ = self.skill_converter.detect_intents(utterance, expectations, debug)
         # For now, we assume single intent.
         result = {
@@ -158,5 +169,8 @@ def load_parser(module_path, index_path):
     # Then load the retriever by pointing to index directory
     context_retriever = load_context_retrievers(module_schema, index_path)
 
+    # The template index is missing for the bots indexed before it is added.
+    templates = TemplateIndex.load(index_path) if TemplateIndex.exists(index_path) else None
+
     # Finally build the converter.
-    return Parser(context_retriever)
+    return Parser(context_retriever, templates=templates)
@@ -1,19 +1,24 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import asyncio
 import dataclasses
 import getopt
 import logging
 import json
 import sys
 from enum import Enum
-import os
-from lru import LRU
 import traceback as tb
 from aiohttp import web
-import shutil
 from opendu.core.config import RauConfig
+from opendu.core.embedding import EmbeddingStore
+from opendu.core.shared_index import SharedMatrix
+from opendu.inference.bot_cache import BotCache
+from opendu.inference.executor import InferenceExecutor, QueueFullError
+from opendu.inference.generator import CachedGenerator
+from opendu.inference.intent_detector import cascade_stats
 from opendu.inference.parser import Parser, Generator, load_parser
-from opendu.inference.index import indexing
+from opendu.inference.index_jobs import IndexJobs
+from opendu.inference.model_jobs import ModelJobs
 from sentence_transformers import SentenceTransformer
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
@@ -37,39 +42,77 @@ async def hello(_: web.Request):  # For heart beat
     return web.Response(text=f"Ok")
 
 
+@routes.get("/v1/stats")
+async def stats(request: web.Request):
+    return web.json_response({
+        "query_embedding_cache": EmbeddingStore.cache_stats(),
+        "bots": request.app["converters"].stats(),
+        "shared_index": SharedMatrix.all_stats(),
+        "cascade": cascade_stats.stats(),
+        "decision_cache": Generator.generator.stats() if isinstance(Generator.generator, CachedGenerator) else {}
+    })
+
+
+@routes.get("/v1/model/reload")
+async def reload_model(request: web.Request):
+    # The model is shared by all the bots, it is loaded in the background next to the serving one,
+    # and the cached decisions of the old model are dropped once it is swapped in.
+    job, started = request.app["model_jobs"].submit()
+
+    # The client can poll the status, 409 if there is one running already.
+    return web.json_response(job, status=200 if started else 409)
+
+
+@routes.get("/v1/model/reload/status")
+async def reload_model_status(request: web.Request):
+    job = request.app["model_jobs"].status()
+    if job is None:
+        return web.json_response({"errMsg": "no model reload job."}, status=404)
+    return web.json_response(job)
+
+
 @routes.get("/v1/index/{bot}")
 async def index(request: web.Request):
     bot = request.match_info['bot']
     root = request.app["root"]
     bot_path = f"{root}/{bot}"
-    index_path = f"{root}/{bot}/index"
-    # We remove converter, delete the index, and index again.
+    # Index again in the background, indexing only embeds the exemplars that changed. The old
+    # converter keeps serving until the new one is loaded and swapped in.
     converters = request.app["converters"]
 
-    # Remove the old object.
-    converters[bot] = None
-    if os.path.exists(index_path):
-        logging.info(f"remove index for {bot}")
-        shutil.rmtree(index_path)
+    def swap():
+        # Assume it is always a good idea to reload the index.
+        converters.put(bot, load_converter(bot, request.app))
 
     logging.info(f"create index for {bot}")
     try:
-        indexing(bot_path)
-
-        # Assume it is always a good idea to reload the index.
-        reload(bot, request.app)
+        job, started = request.app["index_jobs"].submit(bot, bot_path, swap)
     except Exception as e:
         traceback_str = ''.join(tb.format_exception(None, e, e.__traceback__))
         return web.Response(text=traceback_str, status=500)
 
-    return web.Response(text="Ok")
+    # The client can poll the status with the job id, 409 if there is one running already.
+    return web.json_response(job, status=200 if started else 409)
+
+
+@routes.get("/v1/index/{bot}/status")
+async def index_status(request: web.Request):
+    bot = request.match_info['bot']
+    job = request.app["index_jobs"].status(bot)
+    if job is None:
+        return web.json_response({"errMsg": f"no index job for {bot}."}, status=404)
+    return web.json_response(job)
 
 
 @routes.get("/v1/load/{bot}")
 async def load(request: web.Request):
     bot = request.match_info['bot']
     try:
-        reload(bot, request.app)
+        await call_inference(request.app, reload, bot, request.app)
+    except QueueFullError as e:
+        return web.Response(text=str(e), status=503)
+    except (asyncio.TimeoutError, TimeoutError):
+        return web.Response(text=f"load {bot} timed out.", status=504)
     except Exception as e:
         traceback_str = ''.join(tb.format_exception(None, e, e.__traceback__))
         return web.Response(text=traceback_str, status=500)
@@ -82,13 +125,6 @@ async def load(request: web.Request):
 async def understand(request: web.Request):
     bot = request.match_info['bot']
 
-    # Make sure we have reload the index.
-    try:
-        reload(bot, request.app)
-    except Exception as e:
-        traceback_str = ''.join(tb.format_exception(None, e, e.__traceback__))
-        return web.Response(text=traceback_str, status=500)
-
     req = await request.json()
     logging.info(req)
 
@@ -97,84 +133,102 @@ async def understand(request: web.Request):
     if len(utterance) == 0:
         return web.json_response({"errMsg": f"empty user input."})
 
+    # Everything below blocks, so we run it on the inference threads.
+    try:
+        results = await call_inference(request.app, predict, bot, req, request.app)
+    except QueueFullError as e:
+        return web.Response(text=str(e), status=503)
+    except (asyncio.TimeoutError, TimeoutError):
+        return web.Response(text=f"predict for {bot} timed out.", status=504)
+    except Exception as e:
+        traceback_str = ''.join(tb.format_exception(None, e, e.__traceback__))
+        return web.Response(text=traceback_str, status=500)
+
+    return web.json_response(results)
+
+
+async def call_inference(app, fn, *args):
+    return await app["executor"].call(RauConfig.get().inference_timeout, fn, *args)
+
+
+# This runs on the inference thread.
+def predict(bot, req, app):
+    # Make sure we have reload the index.
+    l_converter: Parser = reload(bot, app)
+
+    utterance = req.get("utterance")
     mode = req.get("mode")
-    l_converter: Parser = request.app["converters"][bot]
 
     if mode == "DESCSIM":
         descriptions = req.get("descriptions")
-        return web.json_response({})
+        return {}
 
     if mode == "EXEMPLARSIM":
         exemplars = req.get("exemplars")
-        return web.json_response({})
+        return {}
 
     if mode == "DEBUG":
         expectations = req.get("expectations")
-        results = l_converter.debug(utterance, expectations)
-        return web.json_response(results)
+        return l_converter.debug(utterance, expectations)
 
     if mode == "SEGMENT":
-        return web.json_response({"errMsg": f"Not implemented yet."})
+        return {"errMsg": f"Not implemented yet."}
 
     if mode == "SKILL":
-        try:
-            expectations = req.get("expectations")
-            results = l_converter.detect_triggerables(utterance, expectations)
-        except Exception as e:
-            traceback_str = ''.join(tb.format_exception(None, e, e.__traceback__))
-            return web.Response(text=traceback_str, status=500)
-
-        return web.json_response(results)
+        expectations = req.get("expectations")
+        return l_converter.detect_triggerables(utterance, expectations)
 
     if mode == "SLOT":
-        try:
-            slots = req.get("slots")
-            entities = req.get("candidates")
-            results = l_converter.fill_slots(utterance, slots, entities)
-            logging.info(results)
-        except Exception as e:
-            traceback_str = ''.join(tb.format_exception(None, e, e.__traceback__))
-            return web.Response(text=traceback_str, status=500)
-
-        return web.json_response(results)
+        slots = req.get("slots")
+        entities = req.get("candidates")
+        results = l_converter.fill_slots(utterance, slots, entities)
+        logging.info(results)
+        return results
 
     if mode == "BINARY":
-        try:
-            questions = req.get("questions")
-            dialog_acts = req.get("dialogActs")
-            # So that we can use different llm.
-            resp = l_converter.inference(utterance, questions)
-        except Exception as e:
-            traceback_str = ''.join(tb.format_exception(None, e, e.__traceback__))
-            return web.Response(text=traceback_str, status=500)
+        questions = req.get("questions")
+        dialog_acts = req.get("dialogActs")
+        # So that we can use different llm.
+        return l_converter.inference(utterance, questions)
 
-        return web.json_response(resp)
 
-
-# This reload the converter from current indexing.
+# This returns the converter, the concurrent requests for a bot that is not loaded yet share
+# one load from current indexing.
 def reload(key, app):
-    root = app["root"]
-    converters = app["converters"]
-    bot_path = f"{root}/{key}"
-    if key not in converters or converters[key] is None:
-        logging.info(f"load index for {key}...")
-        index_path = f"{bot_path}/index/"
-        converters[key] = load_parser(bot_path, index_path)
-        logging.info(f"bot {key} is ready.")
-
-def init_app(schema_root, size):
+    return app["converters"].get_or_load(key, lambda: load_converter(key, app))
+
+
+def load_converter(key, app):
+    bot_path = f"{app['root']}/{key}"
+    logging.info(f"load index for {key}...")
+    converter = load_parser(bot_path, f"{bot_path}/index/")
+    logging.info(f"bot {key} is ready.")
+    return converter
+
+
+async def shutdown_jobs(app):
+    app["index_jobs"].shutdown()
+    app["model_jobs"].shutdown()
+
+
+def init_app(schema_root, budget, capacity):
     app = web.Application()
     app.add_routes(routes)
-    app["converters"] = LRU(size)
+    app["converters"] = BotCache(budget, capacity)
+    app["executor"] = InferenceExecutor(RauConfig.get().inference_workers, RauConfig.get().inference_queue_size)
+    app["index_jobs"] = IndexJobs(RauConfig.get().index_workers)
+    app["model_jobs"] = ModelJobs()
+    app.on_cleanup.append(shutdown_jobs)
     app['root'] = schema_root
     return app
 
 
 if __name__ == "__main__":
     argv = sys.argv[1:]
-    opts, args = getopt.getopt(argv, "hi:s:")
+    opts, args = getopt.getopt(argv, "hi:b:s:")
     cmd = False
-    lru_capacity = 32
+    cache_budget = RauConfig.get().bot_cache_budget
+    cache_capacity = RauConfig.get().bot_cache_capacity
     for opt, arg in opts:
         if opt == "-h":
             print(
@@ -184,9 +238,12 @@ if __name__ == "__main__":
         elif opt == "-s":
             root_path = arg
         elif opt == "-i":
-            lru_capacity = int(arg)
+            cache_capacity = int(arg)
+        elif opt == "-b":
+            # The budget for loaded bots in megabytes.
+            cache_budget = int(arg) * 1024 * 1024
 
     # This load the generator LLM first.
     embedder = SentenceTransformer(RauConfig.get().embedding_model, device=RauConfig.get().embedding_device, trust_remote_code=True)
     Generator.build()
-    web.run_app(init_app(root_path, lru_capacity), port=3001)
+    web.run_app(init_app(root_path, cache_budget, cache_capacity), port=3001)